@@ -1,24 +1,55 @@
 from django.contrib import admin
+from django.db.models import Count, Prefetch
 from .models import PledgeRecord, UploadLog, SMSMessage
 
 
 @admin.register(PledgeRecord)
 class PledgeRecordAdmin(admin.ModelAdmin):
     list_display = ['mobile_number', 'name', 'pledge', 'paid', 'remaining', 'card_capacity', 'card_code',
-                   'normal_message_sent', 'whatsapp_sent', 'updated_at']
+                   'normal_message_sent', 'whatsapp_sent', 'sms_count', 'last_sms_status', 'updated_at']
     list_filter = ['card_capacity', 'normal_message_sent', 'whatsapp_sent', 'created_at', 'updated_at']
     search_fields = ['name', 'mobile_number', 'card_code']
     list_editable = ['name', 'pledge', 'paid', 'normal_message_sent', 'whatsapp_sent']
     readonly_fields = ['id', 'remaining', 'card_capacity', 'card_code', 'created_at', 'updated_at']
     ordering = ['-updated_at']
+    actions = ['recompute_totals']
+
+    def get_queryset(self, request):
+        # Count SMS messages in the list query instead of one COUNT per row
+        # and prefetch only the latest message, with just the columns the list shows
+        latest_sms = SMSMessage.objects.only('id', 'pledge_record_id', 'status', 'sent_at', 'message_type').order_by('-sent_at')[:1]
+        return super().get_queryset(request).annotate(
+            _sms_count=Count('sms_messages')
+        ).prefetch_related(
+            Prefetch('sms_messages', queryset=latest_sms, to_attr='latest_sms_messages')
+        )
+
+    @admin.display(description="SMS count", ordering='_sms_count')
+    def sms_count(self, obj):
+        return obj._sms_count
+
+    @admin.display(description="Last SMS")
+    def last_sms_status(self, obj):
+        if not obj.latest_sms_messages:
+            return "-"
+        return obj.latest_sms_messages[0].get_status_display()
+
+    @admin.action(description="Recompute totals")
+    def recompute_totals(self, request, queryset):
+        updated = PledgeRecord.recompute_derived_fields(queryset)
+        self.message_user(
+            request, f"Recomputed remaining amount and card capacity; {updated} record(s) changed."
+        )
 
 
 @admin.register(UploadLog)
 class UploadLogAdmin(admin.ModelAdmin):
-    list_display = ['filename', 'uploaded_at', 'total_records', 'new_records', 'updated_records']
-    list_filter = ['uploaded_at']
+    list_display = ['filename', 'uploaded_at', 'status', 'total_records', 'new_records', 'updated_records',
+                    'duplicate_records']
+    list_filter = ['status', 'uploaded_at']
     search_fields = ['filename']
-    readonly_fields = ['uploaded_at', 'filename', 'total_records', 'new_records', 'updated_records', 'errors']
+    readonly_fields = ['uploaded_at', 'updated_at', 'status', 'filename', 'total_records', 'new_records',
+                       'updated_records', 'duplicate_records', 'errors']
     ordering = ['-uploaded_at']
 
 
@@ -29,6 +60,4 @@ class SMSMessageAdmin(admin.ModelAdmin):
     search_fields = ['recipient_name', 'recipient_mobile', 'pledge_record__name', 'pledge_record__mobile_number', 'message_id']
     readonly_fields = ['sent_at', 'message_id']
     ordering = ['-sent_at']
-    
-    def get_queryset(self, request):
-        return super().get_queryset(request).select_related('pledge_record')
+    list_select_related = ['pledge_record']
@@ -17,6 +17,7 @@ class PledgeRecordForm(forms.ModelForm):
     mobile_number = forms.CharField(
         max_length=15,
         required=True,
+        error_messages={'unique': "A record with this mobile number already exists"},
         widget=forms.TextInput(attrs={
             'class': 'w-full px-3 py-2 border border-gray-300 rounded-md focus:outline-none focus:ring-2 focus:ring-blue-500 focus:border-transparent',
             'placeholder': 'Enter mobile number'
@@ -42,6 +43,14 @@ class PledgeRecordForm(forms.ModelForm):
                 'placeholder': 'Enter paid amount'
             }),
         }
+    
+    def save(self, commit=True):
+        instance = super().save(commit=False)
+        if commit:
+            # is_valid() has already run full_clean() on this instance
+            instance.save(skip_validation=True)
+            self._save_m2m()
+        return instance
         
     def clean_mobile_number(self):
         mobile_number = self.cleaned_data.get('mobile_number')
@@ -53,14 +62,8 @@ class PledgeRecordForm(forms.ModelForm):
             formatted_number = format_phone_number(mobile_number.strip())
             validate_phone_number(formatted_number)
             
-            # Check for uniqueness (exclude current instance if editing)
-            queryset = PledgeRecord.objects.filter(mobile_number=formatted_number)
-            if self.instance and self.instance.pk:
-                queryset = queryset.exclude(pk=self.instance.pk)
-            
-            if queryset.exists():
-                raise forms.ValidationError("A record with this mobile number already exists")
-                
+            # Uniqueness is checked once by the model form's validate_unique()
+            # and enforced by the database's unique index
             return formatted_number
         except ValidationError as e:
             raise forms.ValidationError(f"Invalid phone number: {str(e)}")
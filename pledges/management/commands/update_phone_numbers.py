@@ -1,36 +1,94 @@
 from django.core.management.base import BaseCommand
+from django.db import DatabaseError, transaction
 from pledges.models import PledgeRecord, format_phone_number
 
 
+# Rows per bulk UPDATE, and rows fetched per round-trip from the server-side cursor
+BATCH_SIZE = 1000
+FETCH_CHUNK_SIZE = 2000
+
+
 class Command(BaseCommand):
     help = 'Update existing phone numbers to follow the standard format (0 + 10 digits)'
 
     def handle(self, *args, **options):
         self.stdout.write('Starting phone number format update...')
-        
-        records = PledgeRecord.objects.all()
+
+        records = PledgeRecord.objects.only('id', 'mobile_number', 'name').iterator(chunk_size=FETCH_CHUNK_SIZE)
         updated_count = 0
         error_count = 0
-        
+        to_update = []
+
         for record in records:
             original_number = record.mobile_number
             try:
                 formatted_number = format_phone_number(original_number)
                 if formatted_number != original_number:
                     record.mobile_number = formatted_number
-                    record.save()
-                    updated_count += 1
-                    self.stdout.write(
-                        f'Updated: {original_number} -> {formatted_number} ({record.name})'
-                    )
+                    to_update.append((record, original_number))
             except Exception as e:
                 error_count += 1
                 self.stdout.write(
                     self.style.ERROR(f'Error updating {original_number} ({record.name}): {str(e)}')
                 )
-        
+
+            if len(to_update) >= BATCH_SIZE:
+                updated, failed = self._flush(to_update)
+                updated_count += updated
+                error_count += failed
+
+        # Flush whatever is left from the last partial batch
+        if to_update:
+            updated, failed = self._flush(to_update)
+            updated_count += updated
+            error_count += failed
+
         self.stdout.write(
             self.style.SUCCESS(
                 f'Phone number update complete. Updated: {updated_count}, Errors: {error_count}'
             )
-        )
\ No newline at end of file
+        )
+
+    def _flush(self, to_update):
+        """
+        Write a batch of formatted numbers with a single bulk UPDATE. If the batch is
+        rejected (e.g. a formatted number is already taken), rows are retried one by one
+        so only the conflicting ones are counted as errors.
+        """
+        try:
+            try:
+                with transaction.atomic():
+                    PledgeRecord.objects.bulk_update(
+                        [record for record, _ in to_update], ['mobile_number'], batch_size=BATCH_SIZE
+                    )
+            except DatabaseError:
+                return self._save_each(to_update)
+            
+            for record, original_number in to_update:
+                self._report_updated(record, original_number)
+            return len(to_update), 0
+        finally:
+            to_update.clear()
+
+    def _save_each(self, to_update):
+        """Write each formatted number on its own, reporting the rows that fail"""
+        updated_count = 0
+        error_count = 0
+        for record, original_number in to_update:
+            try:
+                with transaction.atomic():
+                    PledgeRecord.objects.filter(pk=record.pk).update(mobile_number=record.mobile_number)
+            except Exception as e:
+                error_count += 1
+                self.stdout.write(
+                    self.style.ERROR(
+                        f'Error updating {original_number} -> {record.mobile_number} ({record.name}): {str(e)}'
+                    )
+                )
+                continue
+            updated_count += 1
+            self._report_updated(record, original_number)
+        return updated_count, error_count
+
+    def _report_updated(self, record, original_number):
+        self.stdout.write(f'Updated: {original_number} -> {record.mobile_number} ({record.name})')
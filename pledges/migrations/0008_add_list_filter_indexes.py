@@ -0,0 +1,41 @@
+# Generated by Django 5.1.5 on 2026-10-15 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pledges', '0007_extend_card_code_length'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pledgerecord',
+            index=models.Index(fields=['-updated_at'], name='pledge_updated_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pledgerecord',
+            index=models.Index(fields=['card_capacity'], name='pledge_card_capacity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pledgerecord',
+            index=models.Index(fields=['normal_message_sent'], name='pledge_sms_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pledgerecord',
+            index=models.Index(fields=['whatsapp_sent'], name='pledge_whatsapp_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pledgerecord',
+            index=models.Index(fields=['card_capacity', '-updated_at'], name='pledge_capacity_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='smsmessage',
+            index=models.Index(fields=['-sent_at'], name='sms_sent_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='smsmessage',
+            index=models.Index(fields=['status', 'message_type'], name='sms_status_type_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.5 on 2026-10-15 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pledges', '0008_add_list_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CardCodeCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_index', models.IntegerField(default=0, help_text='Next counter value to hand out')),
+            ],
+            options={
+                'verbose_name': 'Card Code Counter',
+                'verbose_name_plural': 'Card Code Counters',
+            },
+        ),
+    ]
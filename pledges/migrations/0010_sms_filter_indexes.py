@@ -0,0 +1,22 @@
+# Generated by Django 5.1.5 on 2026-10-15 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pledges', '0009_cardcodecounter'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='smsmessage',
+            name='message_type',
+            field=models.CharField(db_index=True, default='wedding_invitation', help_text='Type of message', max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='smsmessage',
+            index=models.Index(fields=['status', '-sent_at'], name='sms_status_sentat_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-15 11:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pledges', '0010_sms_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadlog',
+            name='duplicate_records',
+            field=models.IntegerField(default=0, help_text='Rows skipped because a later row had the same mobile number'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-15 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pledges', '0011_uploadlog_duplicate_records'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadlog',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed')], default='completed', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='uploadlog',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -1,11 +1,22 @@
-import random
 import string
 import uuid
-from django.db import models
+from decimal import Decimal
+from functools import lru_cache
+import pandas as pd
+from django.db import models, transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
 from django.core.exceptions import ValidationError
 import re
 
 
+_NON_DIGIT_RE = re.compile(r'[^0-9]')
+_INTL_RE = re.compile(r'^\+[1-9]\d{1,14}$')
+
+# Deletes every ASCII character except 0-9; str.translate does this in a C loop
+_NON_DIGIT_TABLE = str.maketrans('', '', ''.join(chr(c) for c in range(128) if not chr(c).isdigit()))
+
+
 def format_phone_number(phone_number):
     """
     Format phone number to ensure it follows the correct format:
@@ -15,14 +26,26 @@ def format_phone_number(phone_number):
     if not phone_number:
         return phone_number
     
-    phone_str = str(phone_number).strip()
+    return _format_phone_str(str(phone_number).strip())
+
+
+# Uploads, retries and forwards format the same numbers over and over
+@lru_cache(maxsize=65536)
+def _format_phone_str(phone_str):
+    """Cached implementation of format_phone_number for a stripped string"""
+    # Already in local format - the common case for stored numbers
+    if len(phone_str) == 10 and phone_str.startswith('0') and phone_str.isascii() and phone_str.isdigit():
+        return phone_str
     
     # If starts with +, return as is
     if phone_str.startswith('+'):
         return phone_str
     
     # Remove any non-digit characters except + at the beginning
-    phone_digits = re.sub(r'[^0-9]', '', phone_str)
+    if phone_str.isascii():
+        phone_digits = phone_str.translate(_NON_DIGIT_TABLE)
+    else:
+        phone_digits = _NON_DIGIT_RE.sub('', phone_str)
     
     # If phone starts with country code like 255, convert to local format
     if phone_digits.startswith('255') and len(phone_digits) == 12:
@@ -54,15 +77,72 @@ def validate_phone_number(phone_number):
     
     # If starts with +, basic validation
     if phone_str.startswith('+'):
-        if not re.match(r'^\+[1-9]\d{1,14}$', phone_str):
+        if not _INTL_RE.match(phone_str):
             raise ValidationError("Invalid international phone number format")
         return
     
     # Local format should be exactly 10 digits starting with 0
-    if not re.match(r'^0\d{9}$', phone_str):
+    if not (len(phone_str) == 10 and phone_str.startswith('0') and phone_str[1:].isdecimal()):
         raise ValidationError("Phone number must start with 0 and have exactly 10 digits")
 
 
+# Exclude characters that look like numbers: O (looks like 0), I (looks like 1), S (looks like 5), Z (looks like 2)
+CARD_CODE_CHARS = 'ABCDEFGHJKLMNPQRTUVWXY'
+CARD_CODE_SPACE = len(CARD_CODE_CHARS) ** 3
+
+# Affine map index -> (index * multiplier + offset) mod space. The multiplier is
+# coprime to the space size, so it is a permutation: consecutive counter values
+# give scattered-looking codes that can never repeat.
+_CARD_CODE_MULTIPLIER = 7919
+_CARD_CODE_OFFSET = 4099
+
+
+def encode_card_code(index):
+    """
+    Turn a counter value into a card code.
+    The first CARD_CODE_SPACE indexes give scrambled 3-letter codes; after that
+    codes grow to 4 letters (and beyond) in plain base-22 order.
+    """
+    base = len(CARD_CODE_CHARS)
+    if index < CARD_CODE_SPACE:
+        value = (index * _CARD_CODE_MULTIPLIER + _CARD_CODE_OFFSET) % CARD_CODE_SPACE
+        length = 3
+    else:
+        value = index - CARD_CODE_SPACE
+        length = 4
+        while value >= base ** length:
+            value -= base ** length
+            length += 1
+    
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, base)
+        chars.append(CARD_CODE_CHARS[digit])
+    return ''.join(reversed(chars))
+
+
+class CardCodeCounter(models.Model):
+    """Single-row counter that card codes are allocated from"""
+    last_index = models.IntegerField(default=0, help_text="Next counter value to hand out")
+
+    class Meta:
+        verbose_name = "Card Code Counter"
+        verbose_name_plural = "Card Code Counters"
+
+    def __str__(self):
+        return f"Card code counter at {self.last_index}"
+
+    @classmethod
+    def allocate(cls, n):
+        """Reserve n consecutive counter values and return the first one"""
+        with transaction.atomic():
+            counter, _ = cls.objects.select_for_update().get_or_create(pk=1)
+            start = counter.last_index
+            counter.last_index = start + n
+            counter.save(update_fields=['last_index'])
+        return start
+
+
 class PledgeRecord(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     mobile_number = models.CharField(max_length=15, unique=True, blank=False, help_text="Mobile number (Unique)")
@@ -83,16 +163,47 @@ class PledgeRecord(models.Model):
         verbose_name = "Pledge Record"
         verbose_name_plural = "Pledge Records"
         ordering = ['-updated_at']
+        # Back the admin list_filter columns and default ordering (mobile_number is already unique)
+        indexes = [
+            models.Index(fields=['-updated_at'], name='pledge_updated_at_idx'),
+            models.Index(fields=['card_capacity'], name='pledge_card_capacity_idx'),
+            models.Index(fields=['normal_message_sent'], name='pledge_sms_sent_idx'),
+            models.Index(fields=['whatsapp_sent'], name='pledge_whatsapp_sent_idx'),
+            models.Index(fields=['card_capacity', '-updated_at'], name='pledge_capacity_updated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.mobile_number})"
 
+    @classmethod
+    def reserve_card_codes(cls, n, used_codes):
+        """
+        Allocate n unique card codes from the shared counter.
+        used_codes is a set of codes already taken (e.g. older random codes);
+        it is updated in place so the same set can be reused across batches.
+        """
+        codes = []
+        while len(codes) < n:
+            needed = n - len(codes)
+            start = CardCodeCounter.allocate(needed)
+            for index in range(start, start + needed):
+                code = encode_card_code(index)
+                if code not in used_codes:
+                    used_codes.add(code)
+                    codes.append(code)
+        return codes
+
+    @classmethod
+    def get_used_card_codes(cls):
+        """Load every card code currently in use as a set"""
+        return set(
+            cls.objects.exclude(card_code__isnull=True).exclude(card_code='').values_list('card_code', flat=True)
+        )
+
     def generate_unique_card_code(self):
-        """Generate a unique 3-letter code excluding confusing characters"""
-        # Exclude characters that look like numbers: O (looks like 0), I (looks like 1), S (looks like 5), Z (looks like 2)
-        allowed_chars = 'ABCDEFGHJKLMNPQRTUVWXY'
+        """Allocate the next card code from the counter, skipping any code already in use"""
         while True:
-            code = ''.join(random.choices(allowed_chars, k=3))
+            code = encode_card_code(CardCodeCounter.allocate(1))
             # Exclude current record when checking for uniqueness
             existing_query = PledgeRecord.objects.filter(card_code=code)
             if self.pk:
@@ -100,21 +211,151 @@ class PledgeRecord(models.Model):
             if not existing_query.exists():
                 return code
 
-    def clean(self):
-        """Validate the model fields"""
-        super().clean()
-        if self.mobile_number:
-            validate_phone_number(self.mobile_number)
-    
-    def save(self, *args, **kwargs):
-        # Format phone number
-        if self.mobile_number:
-            self.mobile_number = format_phone_number(self.mobile_number)
+    @classmethod
+    def recompute_derived_fields(cls, queryset=None):
+        """
+        Recalculate remaining and card_capacity in a single UPDATE, using the
+        same rules as save(). Manually set special capacities (> 2) are preserved.
+        Only rows whose values change are written, so updated_at (which marks saved
+        invitation images stale) moves only for those. Returns the number of rows changed.
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+        remaining = F('pledge') - F('paid')
+        card_capacity = Case(
+            When(card_capacity__gt=2, then=F('card_capacity')),
+            When(paid__gte=100000, then=2),
+            When(paid__gte=50000, then=1),
+            default=0,
+        )
+        with transaction.atomic():
+            # update() skips auto_now, so updated_at is set explicitly
+            return queryset.filter(~Q(remaining=remaining) | ~Q(card_capacity=card_capacity)).update(
+                remaining=remaining,
+                card_capacity=card_capacity,
+                updated_at=timezone.now(),
+            )
+
+    @classmethod
+    def build_batch(cls, df):
+        """
+        Build unsaved records from a DataFrame with name, mobile_number, pledge
+        and paid columns, ready for bulk_create_with_card_codes().
+        Columns are cleaned as a whole; rows without a mobile number are skipped.
+        Returns (records, errors) where errors name the rows that could not be read.
+        """
+        mobile_numbers = df['mobile_number'].astype(str).str.strip()
+        has_number = ~mobile_numbers.str.lower().isin(['nan', 'none', ''])
+        df = df[has_number]
+        mobile_numbers = mobile_numbers[has_number]
         
-        # Generate card code only if it's completely empty/null
-        if not self.card_code or self.card_code.strip() == '':
-            self.card_code = self.generate_unique_card_code()
+        pledges = df['pledge'].astype(str).str.replace(',', '', regex=False).str.strip()
+        paid_amounts = df['paid'].astype(str).str.replace(',', '', regex=False).str.strip()
+        
+        # Drop rows whose amounts aren't finite numbers in one pass (NaN fails the comparison)
+        valid_amounts = (
+            (pd.to_numeric(pledges, errors='coerce').abs() < float('inf'))
+            & (pd.to_numeric(paid_amounts, errors='coerce').abs() < float('inf'))
+        )
+        errors = [f"Row {index + 1}: invalid pledge or paid amount" for index in df.index[~valid_amounts]]
+        df = df[valid_amounts]
+        
+        # Formatting is cached, so repeated numbers cost a dict lookup
+        mobile_numbers = mobile_numbers[valid_amounts].map(format_phone_number)
+        names = df['name'].astype(str).str.strip()
+        
+        pledges = pledges[valid_amounts].tolist()
+        paid_amounts = paid_amounts[valid_amounts].tolist()
         
+        # Decimal is built from the cleaned string so no float rounding creeps in;
+        # amounts repeat a lot, so each distinct string is parsed once
+        decimals = {amount: Decimal(amount) for amount in {*pledges, *paid_amounts}}
+        
+        # bulk_create skips full_clean, so check each distinct amount against the field's
+        # max_digits/decimal_places here rather than letting the insert fail or round it
+        pledge_errors = cls._amount_errors('pledge', {decimals[amount] for amount in pledges})
+        paid_errors = cls._amount_errors('paid', {decimals[amount] for amount in paid_amounts})
+        
+        records = []
+        rows = zip(df.index.tolist(), mobile_numbers.tolist(), names.tolist(), pledges, paid_amounts)
+        for index, mobile_number, name, pledge, paid in rows:
+            amount_errors = [
+                message for message in (pledge_errors.get(decimals[pledge]), paid_errors.get(decimals[paid]))
+                if message
+            ]
+            if amount_errors:
+                errors.append(f"Row {index + 1}: {'; '.join(amount_errors)}")
+                continue
+            try:
+                validate_phone_number(mobile_number)
+            except ValidationError as e:
+                errors.append(f"Row {index + 1}: {'; '.join(e.messages)}")
+                continue
+            records.append(cls(mobile_number=mobile_number, name=name, pledge=decimals[pledge], paid=decimals[paid]))
+        
+        return records, errors
+
+    @classmethod
+    def _amount_errors(cls, field_name, amounts):
+        """Map each amount that field_name's validators reject to its error message"""
+        field = cls._meta.get_field(field_name)
+        errors = {}
+        for amount in amounts:
+            try:
+                field.run_validators(amount)
+            except ValidationError as e:
+                errors[amount] = f"{field.verbose_name}: {'; '.join(e.messages)}"
+        return errors
+
+    @classmethod
+    def bulk_create_with_card_codes(cls, records, batch_size=500, max_attempts=3):
+        """
+        Insert new records with bulk_create, giving each one a card code.
+        bulk_create bypasses save(), so phone formatting and derived fields are
+        applied here. Rows the database rejects because of a card_code clash get
+        a fresh code and are retried; rows whose mobile number already exists
+        are dropped. Returns the records that were inserted.
+        """
+        records = list(records)
+        for record in records:
+            record.mobile_number = format_phone_number(record.mobile_number)
+            record.apply_derived_fields()
+        
+        used_codes = cls.get_used_card_codes()
+        inserted_ids = set()
+        pending = records
+        for _ in range(max_attempts):
+            if not pending:
+                break
+            
+            without_code = [record for record in pending if not record.card_code]
+            for record, code in zip(without_code, cls.reserve_card_codes(len(without_code), used_codes)):
+                record.card_code = code
+            
+            with transaction.atomic():
+                cls.objects.bulk_create(pending, batch_size=batch_size, ignore_conflicts=True)
+            
+            # Primary keys are generated client-side, so check which rows landed
+            for start in range(0, len(pending), batch_size):
+                batch_ids = [record.id for record in pending[start:start + batch_size]]
+                inserted_ids.update(cls.objects.filter(id__in=batch_ids).values_list('id', flat=True))
+            rejected = [record for record in pending if record.id not in inserted_ids]
+            if not rejected:
+                break
+            
+            taken_numbers = set(
+                cls.objects.filter(
+                    mobile_number__in=[record.mobile_number for record in rejected]
+                ).values_list('mobile_number', flat=True)
+            )
+            pending = [record for record in rejected if record.mobile_number not in taken_numbers]
+            for record in pending:
+                record.card_code = ''
+        
+        return [record for record in records if record.id in inserted_ids]
+
+    def apply_derived_fields(self):
+        """Calculate remaining and card_capacity from pledge and paid"""
         # Automatically calculate remaining amount
         self.remaining = self.pledge - self.paid
         
@@ -127,18 +368,50 @@ class PledgeRecord(models.Model):
                 self.card_capacity = 1
             else:
                 self.card_capacity = 0
+
+    def clean(self):
+        """Validate the model fields"""
+        super().clean()
+        if self.mobile_number:
+            validate_phone_number(self.mobile_number)
+    
+    def save(self, *args, skip_validation=False, **kwargs):
+        """
+        Pass skip_validation=True from bulk paths that have already formatted
+        and validated the data, to avoid the extra queries in full_clean().
+        """
+        # Format phone number
+        if self.mobile_number:
+            self.mobile_number = format_phone_number(self.mobile_number)
+        
+        # Generate card code only if it's completely empty/null
+        if not self.card_code or self.card_code.strip() == '':
+            self.card_code = self.generate_unique_card_code()
+        
+        self.apply_derived_fields()
         
         # Validate before saving
-        self.full_clean()
+        if not skip_validation:
+            self.full_clean()
         super().save(*args, **kwargs)
 
 
 class UploadLog(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('processing', 'Processing'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='completed')
     filename = models.CharField(max_length=255)
     total_records = models.IntegerField(default=0)
     new_records = models.IntegerField(default=0)
     updated_records = models.IntegerField(default=0)
+    duplicate_records = models.IntegerField(default=0, help_text="Rows skipped because a later row had the same mobile number")
     errors = models.TextField(blank=True, help_text="Any errors during upload")
 
     class Meta:
@@ -149,6 +422,10 @@ class UploadLog(models.Model):
     def __str__(self):
         return f"Upload {self.filename} at {self.uploaded_at}"
 
+    @property
+    def is_finished(self):
+        return self.status in ('completed', 'failed')
+
 
 class SMSMessage(models.Model):
     STATUS_CHOICES = [
@@ -165,12 +442,17 @@ class SMSMessage(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     message_id = models.CharField(max_length=255, blank=True, help_text="SMS provider message ID")
     error_message = models.TextField(blank=True, help_text="Error details if failed")
-    message_type = models.CharField(max_length=50, default='wedding_invitation', help_text="Type of message")
+    message_type = models.CharField(max_length=50, default='wedding_invitation', db_index=True, help_text="Type of message")
     
     class Meta:
         verbose_name = "SMS Message"
         verbose_name_plural = "SMS Messages"
         ordering = ['-sent_at']
+        indexes = [
+            models.Index(fields=['-sent_at'], name='sms_sent_at_idx'),
+            models.Index(fields=['status', 'message_type'], name='sms_status_type_idx'),
+            models.Index(fields=['status', '-sent_at'], name='sms_status_sentat_idx'),
+        ]
     
     def __str__(self):
         return f"SMS to {self.pledge_record.name} at {self.sent_at} - {self.status}"
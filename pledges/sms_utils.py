@@ -1,32 +1,45 @@
 from django.conf import settings
+from django.db import transaction
 from notify_africa import NotifyAfrica
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Rows per INSERT/UPDATE statement when writing SMS audit records in bulk
+BULK_BATCH_SIZE = 500
+
+# Card capacity labels used in messages; other capacities are shown as the number
+_CAP_LABEL = {2: 'DOUBLE', 1: 'SINGLE'}
+_CAP_LABEL_TITLE = {2: 'Double', 1: 'Single'}
+
+
+_CLIENT = None
+
+
+def _get_client():
+    """Return the shared NotifyAfrica client so its HTTP session (and TLS connection) is reused"""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = NotifyAfrica(apiToken=settings.NOTIFY_AFRICA_API_TOKEN)
+    return _CLIENT
+
 
 class SMSService:
     def __init__(self):
-        self.client = NotifyAfrica(apiToken=settings.NOTIFY_AFRICA_API_TOKEN)
+        self.client = _get_client()
         self.sender_id = settings.NOTIFY_AFRICA_SENDER_ID
+        self.default_template = settings.SMS_DEFAULT_MESSAGE
     
-    def send_pledge_sms(self, pledge_record, custom_message=None):
+    def format_pledge_message(self, pledge_record, custom_message=None):
         """
-        Send SMS to a pledge record holder
+        Build the SMS text for a pledge record from the custom or default template
         """
-        from .models import SMSMessage  # Import here to avoid circular imports
-        
         # Format card capacity for display
-        if pledge_record.card_capacity == 2:
-            capacity_display = "DOUBLE"
-        elif pledge_record.card_capacity == 1:
-            capacity_display = "SINGLE"
-        else:
-            capacity_display = str(pledge_record.card_capacity)
+        capacity_display = _CAP_LABEL.get(pledge_record.card_capacity, str(pledge_record.card_capacity))
         
         # Format the message
         if custom_message:
-            message = custom_message.format(
+            return custom_message.format(
                 name=pledge_record.name,
                 pledge=pledge_record.pledge,
                 paid=pledge_record.paid,
@@ -35,15 +48,22 @@ class SMSService:
                 card_code=pledge_record.card_code,
                 card_capacity=capacity_display
             )
-        else:
-            message = settings.SMS_DEFAULT_MESSAGE.format(
-                name=pledge_record.name,
-                pledge=pledge_record.pledge,
-                paid=pledge_record.paid,
-                remaining=pledge_record.remaining,
-                card_code=pledge_record.card_code,
-                card_capacity=capacity_display
-            )
+        return self.default_template.format(
+            name=pledge_record.name,
+            pledge=pledge_record.pledge,
+            paid=pledge_record.paid,
+            remaining=pledge_record.remaining,
+            card_code=pledge_record.card_code,
+            card_capacity=capacity_display
+        )
+    
+    def send_pledge_sms(self, pledge_record, custom_message=None):
+        """
+        Send SMS to a pledge record holder
+        """
+        from .models import SMSMessage  # Import here to avoid circular imports
+        
+        message = self.format_pledge_message(pledge_record, custom_message)
         
         # Create SMS record
         sms_record = SMSMessage.objects.create(
@@ -93,13 +113,75 @@ class SMSService:
     
     def send_bulk_sms(self, pledge_records, custom_message=None):
         """
-        Send SMS to multiple pledge records
+        Send SMS to multiple pledge records.
+        SMS audit rows are written with bulk_create/bulk_update, and records that
+        render to the same text are sent with one batch request to the provider.
         """
+        from .models import SMSMessage  # Import here to avoid circular imports
+        
+        message_type = 'wedding_invitation' if not custom_message else 'custom'
+        sms_records = [
+            SMSMessage(
+                pledge_record=record,
+                recipient_name=record.name,
+                recipient_mobile=record.mobile_number,
+                message_content=self.format_pledge_message(record, custom_message),
+                message_type=message_type,
+                status='pending'
+            )
+            for record in pledge_records
+        ]
+        
+        with transaction.atomic():
+            SMSMessage.objects.bulk_create(sms_records, batch_size=BULK_BATCH_SIZE)
+        
+        # Group recipients by message text; personalised templates mostly give groups of one
+        groups = {}
+        for sms_record in sms_records:
+            groups.setdefault(sms_record.message_content, []).append(sms_record)
+        
+        # Provider calls happen outside of any transaction
+        for message, group in groups.items():
+            try:
+                if len(group) == 1:
+                    response = self.client.send_single_message(
+                        phoneNumber=group[0].recipient_mobile,
+                        message=message,
+                        senderId=self.sender_id,
+                    )
+                    group[0].message_id = response.messageId
+                    logger.info(f"SMS sent to {group[0].recipient_mobile}. Message ID: {response.messageId}, Status: {response.status}")
+                else:
+                    response = self.client.send_batch_messages(
+                        phoneNumbers=[sms_record.recipient_mobile for sms_record in group],
+                        message=message,
+                        senderId=self.sender_id,
+                    )
+                    logger.info(f"Batch SMS sent to {len(group)} recipients. Message count: {response.messageCount}")
+                for sms_record in group:
+                    sms_record.status = 'sent'
+            except Exception as e:
+                for sms_record in group:
+                    sms_record.status = 'failed'
+                    sms_record.error_message = str(e)
+                logger.error(f"Failed to send SMS to {', '.join(r.recipient_mobile for r in group)}: {str(e)}")
+        
+        with transaction.atomic():
+            SMSMessage.objects.bulk_update(sms_records, ['status', 'message_id', 'error_message'], batch_size=BULK_BATCH_SIZE)
+        
         results = []
-        for record in pledge_records:
-            result = self.send_pledge_sms(record, custom_message)
-            result['mobile_number'] = record.mobile_number
-            result['name'] = record.name
+        for sms_record in sms_records:
+            result = {
+                'success': sms_record.status == 'sent',
+                'message': sms_record.message_content,
+                'sms_record_id': sms_record.id,
+                'mobile_number': sms_record.recipient_mobile,
+                'name': sms_record.recipient_name
+            }
+            if result['success']:
+                result['message_id'] = sms_record.message_id
+            else:
+                result['error'] = sms_record.error_message
             results.append(result)
         
         return results
@@ -111,12 +193,7 @@ class SMSService:
         from .models import SMSMessage  # Import here to avoid circular imports
         
         # Format card capacity for display
-        if original_record.card_capacity == 2:
-            capacity_display = "Double"
-        elif original_record.card_capacity == 1:
-            capacity_display = "Single"
-        else:
-            capacity_display = str(original_record.card_capacity)
+        capacity_display = _CAP_LABEL_TITLE.get(original_record.card_capacity, str(original_record.card_capacity))
         
         # Format the message
         if custom_message:
@@ -131,7 +208,7 @@ class SMSService:
             )
         else:
             # Use SMS_DEFAULT_MESSAGE template from settings
-            message = settings.SMS_DEFAULT_MESSAGE.format(
+            message = self.default_template.format(
                 name=original_record.name,
                 pledge=original_record.pledge,
                 paid=original_record.paid,
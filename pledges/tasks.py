@@ -0,0 +1,195 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import PledgeRecord, UploadLog
+from .sms_utils import SMSService
+from .upload_utils import process_upload_data, read_upload_chunks
+from .whatsapp_utils import WhatsAppService
+
+logger = logging.getLogger(__name__)
+
+# Number of records handed to a single background task
+TASK_CHUNK_SIZE = 200
+
+# PledgeRecord fields read when rendering an SMS
+SMS_RECORD_FIELDS = ('id', 'name', 'mobile_number', 'pledge', 'paid', 'remaining', 'card_code', 'card_capacity')
+
+# Failed sends are retried this many times, waiting TASK_RETRY_BACKOFF seconds
+# before the first retry and doubling the wait for each one after
+TASK_MAX_RETRIES = getattr(settings, 'BACKGROUND_TASK_MAX_RETRIES', 2)
+TASK_RETRY_BACKOFF = getattr(settings, 'BACKGROUND_TASK_RETRY_BACKOFF', 30)
+
+# Successful sends are flagged with one UPDATE per this many records
+FLAG_UPDATE_BATCH_SIZE = 100
+
+# Pause between WhatsApp sends to stay under the provider's rate limit
+WHATSAPP_SEND_INTERVAL = getattr(settings, 'WHATSAPP_SEND_INTERVAL', 2)
+
+# In-process task queue: views submit work here and return immediately,
+# and up to BACKGROUND_TASK_WORKERS provider calls run concurrently
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'BACKGROUND_TASK_WORKERS', 8),
+    thread_name_prefix='pledges-task',
+)
+
+
+# Uploads write many rows in one transaction, so they run one at a time
+_upload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pledges-upload')
+
+
+def enqueue(task, *args, executor=None, **kwargs):
+    """Run a task function on the background pool and log any uncaught error"""
+    future = (executor or _executor).submit(task, *args, **kwargs)
+    future.add_done_callback(_log_task_failure)
+    return future
+
+
+def _log_task_failure(future):
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Background task failed: {str(error)}", exc_info=error)
+
+
+def enqueue_later(delay, task, *args, **kwargs):
+    """Enqueue a task after delay seconds without holding a pool worker while waiting"""
+    timer = threading.Timer(delay, enqueue, args=(task, *args), kwargs=kwargs)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def chunked(items, size=TASK_CHUNK_SIZE):
+    """Split a list into consecutive slices of at most size items"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def send_pledge_sms_task(record_ids, custom_message=None):
+    """Send SMS to a chunk of pledge records using the bulk SMS path"""
+    try:
+        # Stream only the fields the message templates use
+        records = PledgeRecord.objects.filter(id__in=record_ids).only(*SMS_RECORD_FIELDS).iterator(
+            chunk_size=TASK_CHUNK_SIZE
+        )
+        results = SMSService().send_bulk_sms(records, custom_message)
+
+        successful_numbers = [result['mobile_number'] for result in results if result['success']]
+        if successful_numbers:
+            PledgeRecord.objects.filter(mobile_number__in=successful_numbers).update(normal_message_sent=True)
+
+        logger.info(
+            f"Background SMS chunk completed: {len(successful_numbers)} successful, "
+            f"{len(results) - len(successful_numbers)} failed"
+        )
+    finally:
+        # Pool threads outlive requests, so release the DB connection explicitly
+        close_old_connections()
+
+
+def send_pledge_whatsapp_task(record_ids, attempt=0):
+    """Send WhatsApp invitations to a chunk of pledge records, retrying transient failures with backoff"""
+    sent_ids = []
+    successful_count = 0
+    # Transient failures are retried; permanent ones (bad number, API rejection) are only counted
+    failed_ids = []
+    permanent_failures = 0
+    try:
+        whatsapp_service = WhatsAppService()
+        # Records sent by an earlier attempt are skipped
+        records = PledgeRecord.objects.filter(id__in=record_ids, whatsapp_sent=False)
+        for record in records.iterator(chunk_size=TASK_CHUNK_SIZE):
+            logger.info(f"Processing WhatsApp for {record.name} (ID: {record.id})")
+            result = whatsapp_service.send_invitation_whatsapp(record, mark_sent=False)
+            if result['success']:
+                sent_ids.append(record.id)
+                successful_count += 1
+                logger.info(f"✓ WhatsApp invitation sent to {record.name}")
+            elif result.get('retryable'):
+                failed_ids.append(record.id)
+                logger.error(f"✗ Failed to send WhatsApp to {record.name}: {result['error']}")
+            else:
+                permanent_failures += 1
+                logger.error(f"✗ Failed to send WhatsApp to {record.name}, not retrying: {result['error']}")
+            
+            if len(sent_ids) >= FLAG_UPDATE_BATCH_SIZE:
+                _mark_whatsapp_sent(sent_ids)
+            
+            # Add small delay to avoid rate limiting
+            time.sleep(WHATSAPP_SEND_INTERVAL)
+        
+        logger.info(
+            f"Background WhatsApp chunk completed: {successful_count} successful, "
+            f"{len(failed_ids) + permanent_failures} failed"
+        )
+    finally:
+        # Flag whatever was sent, even if the chunk stopped early
+        if sent_ids:
+            _mark_whatsapp_sent(sent_ids)
+        close_old_connections()
+    
+    if failed_ids and attempt < TASK_MAX_RETRIES:
+        delay = TASK_RETRY_BACKOFF * 2 ** attempt
+        logger.info(f"Retrying WhatsApp for {len(failed_ids)} records in {delay}s")
+        enqueue_later(delay, send_pledge_whatsapp_task, failed_ids, attempt + 1)
+
+
+def send_invitation_whatsapp_task(record_id):
+    """Render and send the WhatsApp invitation for one pledge record, even if it was sent before"""
+    try:
+        record = PledgeRecord.objects.filter(pk=record_id).first()
+        if record is None:
+            logger.warning(f"WhatsApp invitation skipped: record {record_id} no longer exists")
+            return
+        
+        result = WhatsAppService().send_invitation_whatsapp(record)
+        if result['success']:
+            logger.info(f"✓ WhatsApp invitation sent to {record.name}")
+        else:
+            logger.error(f"✗ Failed to send WhatsApp to {record.name}: {result['error']}")
+    finally:
+        close_old_connections()
+
+
+def _mark_whatsapp_sent(sent_ids):
+    """Flag a batch of records as sent with a single UPDATE and clear the batch"""
+    PledgeRecord.objects.filter(id__in=sent_ids).update(whatsapp_sent=True)
+    sent_ids.clear()
+
+
+def enqueue_upload(path, upload_log):
+    """Queue a saved upload for processing behind any uploads already queued"""
+    return enqueue(process_upload_task, path, upload_log.pk, executor=_upload_executor)
+
+
+def process_upload_task(path, upload_log_id):
+    """Parse a saved upload into its UploadLog's records, then delete the saved file"""
+    try:
+        upload_log = UploadLog.objects.filter(pk=upload_log_id).first()
+        if upload_log is None or upload_log.status != 'queued':
+            # Deleted, or already failed by cleanup_stale_uploads
+            logger.warning(f"Upload log {upload_log_id} is no longer queued; skipping {path}")
+            return
+        
+        upload_log.status = 'processing'
+        upload_log.save(update_fields=['status', 'updated_at'])
+        try:
+            result = process_upload_data(read_upload_chunks(path), upload_log.filename, upload_log=upload_log)
+            logger.info(f"Upload {upload_log.filename} processed: {result['message']}")
+        except Exception as e:
+            # Chunk failures are logged by process_upload_data; this covers files that can't be opened at all
+            logger.error(f"Error processing upload {upload_log.filename}: {str(e)}", exc_info=True)
+            UploadLog.objects.filter(pk=upload_log.pk).update(
+                status='failed', errors=f"Error processing file: {str(e)}", updated_at=timezone.now()
+            )
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            logger.warning(f"Could not delete uploaded file {path}")
+        close_old_connections()
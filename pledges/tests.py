@@ -1,3 +1,185 @@
-from django.test import TestCase
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import pandas as pd
+import requests
+from django.test import SimpleTestCase, TestCase
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+from . import tasks
+from .models import CARD_CODE_SPACE, CardCodeCounter, PledgeRecord, UploadLog, encode_card_code
+from .upload_utils import process_upload_data
+from .views import build_search_filter
+from .whatsapp_utils import WhatsAppService, request_never_sent
+
+
+def upload_frame(rows):
+    """DataFrame shaped like a parsed upload, with every cell read as a string"""
+    return pd.DataFrame(rows, columns=['Name', 'Mobile Number', 'Pledge', 'Paid'], dtype=str)
+
+
+class UploadProcessingTests(TestCase):
+    def setUp(self):
+        self.existing = PledgeRecord.objects.create(
+            name='Existing', mobile_number='0711000001', pledge=Decimal('1000'), paid=Decimal('0')
+        )
+
+    def test_counts_new_updated_duplicate_and_error_rows(self):
+        df = upload_frame([
+            ['Existing Renamed', '0711000001', '200000', '150000'],
+            ['New Person', '255711000002', '5000', '100'],
+            ['First Copy', '0711000003', '10', '0'],
+            ['Second Copy', '0711000003', '20', '0'],
+            ['Bad Amount', '0711000004', 'abc', '0'],
+            ['Too Big', '0711000005', '1000000000000000', '0'],
+            ['Bad Number', '+1', '10', '0'],
+        ])
+
+        result = process_upload_data(df, 'pledges.csv')
+
+        self.assertEqual(result['total_records'], 7)
+        self.assertEqual(result['new_records'], 2)
+        self.assertEqual(result['updated_records'], 1)
+        self.assertEqual(result['duplicate_records'], 1)
+        self.assertEqual(len(result['errors']), 3)
+
+        log = UploadLog.objects.get()
+        self.assertEqual(log.status, 'completed')
+        self.assertEqual((log.new_records, log.updated_records, log.duplicate_records), (2, 1, 1))
+
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.name, 'Existing Renamed')
+        self.assertEqual(self.existing.remaining, Decimal('50000'))
+        self.assertEqual(self.existing.card_capacity, 2)
+        # The last row for a repeated number wins, and numbers are stored in local format
+        self.assertEqual(PledgeRecord.objects.get(mobile_number='0711000003').name, 'Second Copy')
+        self.assertTrue(PledgeRecord.objects.filter(mobile_number='0711000002').exists())
+        self.assertFalse(PledgeRecord.objects.filter(mobile_number='0711000005').exists())
+
+    def test_new_records_get_card_codes(self):
+        df = upload_frame([['A', '0711000010', '10', '0'], ['B', '0711000011', '10', '0']])
+
+        process_upload_data(df, 'pledges.csv')
+
+        codes = list(PledgeRecord.objects.exclude(pk=self.existing.pk).values_list('card_code', flat=True))
+        self.assertEqual(len(codes), 2)
+        self.assertTrue(all(codes))
+        self.assertEqual(len(set(codes)), 2)
+
+    def test_missing_columns_fail_the_upload(self):
+        df = pd.DataFrame([['A', '10']], columns=['Name', 'Pledge'], dtype=str)
+
+        result = process_upload_data(df, 'pledges.csv', upload_log=UploadLog.objects.create(
+            filename='pledges.csv', status='processing'
+        ))
+
+        self.assertEqual(result['total_records'], 0)
+        self.assertEqual(UploadLog.objects.get().status, 'failed')
+
+
+class CardCodeTests(TestCase):
+    def test_three_letter_codes_are_a_permutation(self):
+        codes = {encode_card_code(index) for index in range(CARD_CODE_SPACE)}
+        self.assertEqual(len(codes), CARD_CODE_SPACE)
+        self.assertTrue(all(len(code) == 3 for code in codes))
+
+    def test_codes_stay_unique_past_the_three_letter_space(self):
+        CardCodeCounter.objects.create(pk=1, last_index=CARD_CODE_SPACE - 3)
+        records = [
+            PledgeRecord(name=f'Guest {i}', mobile_number=f'07120000{i:02d}', pledge=Decimal('10'))
+            for i in range(6)
+        ]
+
+        PledgeRecord.bulk_create_with_card_codes(records)
+
+        codes = list(PledgeRecord.objects.values_list('card_code', flat=True))
+        self.assertEqual(len(codes), 6)
+        self.assertEqual(len(set(codes)), 6)
+        self.assertEqual(sorted(len(code) for code in codes), [3, 3, 3, 4, 4, 4])
+
+    def test_codes_already_in_use_are_skipped(self):
+        taken = encode_card_code(0)
+        PledgeRecord.objects.create(name='Old', mobile_number='0712000100', card_code=taken)
+        CardCodeCounter.objects.update_or_create(pk=1, defaults={'last_index': 0})
+
+        record = PledgeRecord.objects.create(name='New', mobile_number='0712000101')
+
+        self.assertNotEqual(record.card_code, taken)
+
+
+class SearchFilterTests(TestCase):
+    def setUp(self):
+        self.guest = PledgeRecord.objects.create(name='John Doe', mobile_number='0712345678')
+        self.room = PledgeRecord.objects.create(name='Room 12', mobile_number='0799000000')
+
+    def search(self, query):
+        return set(PledgeRecord.objects.filter(build_search_filter(query)))
+
+    def test_partial_number_matches_part_of_a_number(self):
+        self.assertEqual(self.search('071234567'), {self.guest})
+        self.assertEqual(self.search('345'), {self.guest})
+
+    def test_complete_number_in_any_form_matches_exactly(self):
+        self.assertEqual(self.search('0712345678'), {self.guest})
+        self.assertEqual(self.search('255712345678'), {self.guest})
+        self.assertEqual(self.search('+255712345678'), {self.guest})
+        self.assertEqual(self.search('0712 345 678'), {self.guest})
+
+    def test_digit_query_also_matches_names(self):
+        self.assertEqual(self.search('12'), {self.guest, self.room})
+
+    def test_text_query_matches_names(self):
+        self.assertEqual(self.search('john'), {self.guest})
+
+
+class RetryClassificationTests(SimpleTestCase):
+    def test_connection_never_made_is_retryable(self):
+        refused = NewConnectionError(None, 'Connection refused')
+        error = requests.ConnectionError(MaxRetryError(None, '/messages', refused))
+        self.assertTrue(request_never_sent(error))
+        self.assertTrue(request_never_sent(requests.ConnectTimeout()))
+
+    def test_dropped_connection_after_sending_is_not_retryable(self):
+        dropped = ProtocolError('Connection aborted.', ConnectionResetError(104, 'reset'))
+        self.assertFalse(request_never_sent(requests.ConnectionError(MaxRetryError(None, '/messages', dropped))))
+        self.assertFalse(request_never_sent(requests.ConnectionError(dropped)))
+        self.assertFalse(request_never_sent(requests.ReadTimeout()))
+        self.assertFalse(request_never_sent(ValueError('bad data')))
+
+    def test_only_throttled_sends_are_retryable(self):
+        service = WhatsAppService()
+        service.api_token = 'token'
+        service.phone_number_id = '123'
+
+        for status_code, retryable in [(429, True), (400, False), (503, False)]:
+            response = mock.Mock(status_code=status_code, text='error')
+            response.json.return_value = {}
+            with mock.patch.object(service.session, 'post', return_value=response):
+                result = service.send_whatsapp_template('255712345678', image_url='https://example.com/a.png')
+            self.assertFalse(result['success'])
+            self.assertEqual(result['retryable'], retryable, status_code)
+
+
+class WhatsAppTaskRetryTests(TestCase):
+    def test_only_retryable_failures_are_resubmitted(self):
+        sent = PledgeRecord.objects.create(name='Sent', mobile_number='0713000001')
+        throttled = PledgeRecord.objects.create(name='Throttled', mobile_number='0713000002')
+        rejected = PledgeRecord.objects.create(name='Rejected', mobile_number='0713000003')
+        results = {
+            sent.pk: {'success': True},
+            throttled.pk: {'success': False, 'error': 'HTTP 429', 'retryable': True},
+            rejected.pk: {'success': False, 'error': 'HTTP 400', 'retryable': False},
+        }
+        service = mock.Mock()
+        service.send_invitation_whatsapp.side_effect = lambda record, mark_sent: results[record.pk]
+
+        with mock.patch.object(tasks, 'WhatsAppService', return_value=service), \
+                mock.patch.object(tasks, 'WHATSAPP_SEND_INTERVAL', 0), \
+                mock.patch.object(tasks, 'close_old_connections'), \
+                mock.patch.object(tasks, 'enqueue_later') as enqueue_later:
+            tasks.send_pledge_whatsapp_task([sent.pk, throttled.pk, rejected.pk])
+
+        enqueue_later.assert_called_once()
+        self.assertEqual(enqueue_later.call_args.args[2], [throttled.pk])
+        sent.refresh_from_db()
+        self.assertTrue(sent.whatsapp_sent)
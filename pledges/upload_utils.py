@@ -0,0 +1,301 @@
+import glob
+import logging
+import os
+import tempfile
+from datetime import timedelta
+from itertools import islice
+
+import openpyxl
+import pandas as pd
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import PledgeRecord, UploadLog
+
+logger = logging.getLogger(__name__)
+
+# Rows per INSERT/UPDATE statement when writing uploaded records
+BULK_BATCH_SIZE = getattr(settings, 'PLEDGE_BULK_BATCH_SIZE', 500)
+
+# Rows read from an uploaded file at a time
+UPLOAD_CHUNK_SIZE = 10_000
+
+UPLOAD_EXTENSIONS = ('.csv', '.xlsx', '.xls')
+
+# Saved uploads are named with this prefix so leftovers can be found and removed
+UPLOAD_FILE_PREFIX = 'pledge-upload-'
+
+# Uploads still queued or processing this long after their last progress update
+# are treated as lost to a restart
+UPLOAD_STALE_AFTER = timedelta(hours=getattr(settings, 'UPLOAD_STALE_AFTER_HOURS', 6))
+
+
+def save_upload(uploaded_file):
+    """Copy an uploaded file to a temporary path that outlives the request and return the path"""
+    suffix = os.path.splitext(uploaded_file.name)[1].lower()
+    with tempfile.NamedTemporaryFile(
+        prefix=UPLOAD_FILE_PREFIX, suffix=suffix, dir=getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None), delete=False
+    ) as destination:
+        for chunk in uploaded_file.chunks():
+            destination.write(chunk)
+    return destination.name
+
+
+def cleanup_stale_uploads():
+    """
+    Fail uploads left queued or processing by a restarted process and delete saved
+    upload files older than UPLOAD_STALE_AFTER. The in-process queue doesn't survive a
+    restart, so nothing else would finish those logs or remove their files.
+    Returns the number of logs marked failed.
+    """
+    cutoff = timezone.now() - UPLOAD_STALE_AFTER
+    failed = UploadLog.objects.filter(status__in=['queued', 'processing'], updated_at__lt=cutoff).update(
+        status='failed',
+        errors="Upload was interrupted before it finished. Please upload the file again.",
+        updated_at=timezone.now(),
+    )
+    
+    upload_dir = getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None) or tempfile.gettempdir()
+    for path in glob.glob(os.path.join(upload_dir, f'{UPLOAD_FILE_PREFIX}*')):
+        try:
+            if os.path.getmtime(path) < cutoff.timestamp():
+                os.remove(path)
+        except OSError:
+            logger.warning(f"Could not delete stale upload file {path}")
+    
+    if failed:
+        logger.warning(f"Marked {failed} interrupted upload(s) as failed")
+    return failed
+
+
+def read_upload_chunks(path):
+    """Read a saved CSV or Excel file as DataFrame chunks; CSV and XLSX are streamed"""
+    if path.endswith('.csv'):
+        return pd.read_csv(
+            path,
+            chunksize=UPLOAD_CHUNK_SIZE,
+            usecols=lambda column: normalize_column_name(column) in ALIAS_TO_STANDARD,
+            dtype=str
+        )
+    if path.endswith('.xlsx'):
+        return read_excel_chunks(path)
+    if path.endswith('.xls'):
+        return [pd.read_excel(path)]
+    raise ValueError("Unsupported file format. Please upload CSV or Excel files.")
+
+
+# Map possible column names
+COLUMN_MAPPING = {
+    'name': ['name', 'full_name', 'person_name'],
+    'mobile_number': ['mobile_number', 'mobile', 'phone', 'phone_number', 'contact'],
+    'pledge': ['pledge', 'pledged', 'pledge_amount'],
+    'paid': ['paid', 'amount_paid', 'paid_amount'],
+    'remaining': ['remaining', 'balance', 'remaining_amount']
+}
+ALIAS_TO_STANDARD = {alias: standard for standard, aliases in COLUMN_MAPPING.items() for alias in aliases}
+REQUIRED_UPLOAD_COLUMNS = ['name', 'mobile_number', 'pledge', 'paid']
+
+
+class MissingColumnsError(ValueError):
+    """An upload is missing one of REQUIRED_UPLOAD_COLUMNS"""
+
+
+def normalize_column_name(column):
+    """Normalize a column header (remove spaces, lowercase)"""
+    return str(column).strip().lower().replace(' ', '_')
+
+
+def read_excel_chunks(source, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Yield DataFrames of at most chunk_size rows from an .xlsx file.
+    pandas has no chunked Excel reader, so rows are streamed with openpyxl's read-only mode.
+    """
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(value) if value is not None else '' for value in next(rows, ())]
+        offset = 0
+        while True:
+            batch = list(islice(rows, chunk_size))
+            if not batch:
+                break
+            yield pd.DataFrame(batch, columns=header, index=range(offset, offset + len(batch)))
+            offset += len(batch)
+    finally:
+        workbook.close()
+
+
+# UploadLog columns written as an upload progresses
+UPLOAD_LOG_FIELDS = [
+    'status', 'total_records', 'new_records', 'updated_records', 'duplicate_records', 'errors', 'updated_at'
+]
+
+
+def process_upload_data(data, filename, upload_log=None):
+    """
+    Process uploaded data and update/create records.
+    data is a DataFrame or an iterable of DataFrame chunks; one UploadLog covers all of them.
+    Pass the upload_log created when the upload was queued to have its counts kept up to
+    date after every chunk; otherwise a log is created when processing finishes.
+    """
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+    
+    total_records = 0
+    new_records = 0
+    updated_records = 0
+    duplicate_records = 0
+    errors = []
+    
+    def save_log(status):
+        log = upload_log or UploadLog(filename=filename)
+        log.status = status
+        log.total_records = total_records
+        log.new_records = new_records
+        log.updated_records = updated_records
+        log.duplicate_records = duplicate_records
+        log.errors = '; '.join(errors) if errors else ''
+        if log.pk:
+            log.save(update_fields=UPLOAD_LOG_FIELDS)
+        else:
+            log.save()
+    
+    status = 'completed'
+    chunks = iter(data)
+    while True:
+        try:
+            df = next(chunks)
+        except StopIteration:
+            break
+        except Exception as e:
+            # The file became unreadable part-way; keep what earlier chunks wrote
+            logger.error(f"Error reading upload {filename}: {str(e)}", exc_info=True)
+            errors.append(f"Error reading file after row {total_records}: {str(e)}")
+            if not total_records:
+                status = 'failed'
+            break
+        
+        total_records += len(df)
+        # Each chunk commits on its own, so a failing chunk only loses its own rows
+        try:
+            with transaction.atomic():
+                chunk_new, chunk_updated, chunk_duplicates, chunk_errors = process_upload_chunk(df)
+        except MissingColumnsError as e:
+            # Every chunk shares the header, so none of the rest can succeed either
+            total_records -= len(df)
+            errors.append(str(e))
+            status = 'failed'
+            break
+        except Exception as e:
+            logger.error(f"Error writing upload chunk from {filename}: {str(e)}", exc_info=True)
+            errors.append(f"Rows {df.index[0] + 1}-{df.index[-1] + 1}: {str(e)}")
+        else:
+            new_records += chunk_new
+            updated_records += chunk_updated
+            duplicate_records += chunk_duplicates
+            errors.extend(chunk_errors)
+        
+        # Progress for the upload status page
+        if upload_log is not None:
+            save_log('processing')
+    
+    save_log(status)
+    
+    message = f"Processed {total_records} records. New: {new_records}, Updated: {updated_records}"
+    if duplicate_records:
+        message += f". Duplicates skipped: {duplicate_records}"
+    if errors:
+        message += f". Errors: {len(errors)}"
+    
+    return {
+        'total_records': total_records,
+        'new_records': new_records,
+        'updated_records': updated_records,
+        'duplicate_records': duplicate_records,
+        'errors': errors,
+        'message': message
+    }
+
+
+def process_upload_chunk(df):
+    """Create/update the records in one chunk of an upload. Returns (new, updated, duplicates, errors)"""
+    df.columns = [normalize_column_name(column) for column in df.columns]
+    
+    # Find actual column names; aliases are tried in COLUMN_MAPPING's priority order
+    present = set(df.columns)
+    actual_columns = {}
+    for standard_name, aliases in COLUMN_MAPPING.items():
+        for alias in aliases:
+            if alias in present:
+                actual_columns[standard_name] = alias
+                break
+    
+    # Check required columns
+    missing_columns = [col for col in REQUIRED_UPLOAD_COLUMNS if col not in actual_columns]
+    
+    if missing_columns:
+        raise MissingColumnsError(f"Missing required columns: {missing_columns}")
+    
+    # Work on a copy with the standard column names
+    upload = df[[actual_columns[col] for col in REQUIRED_UPLOAD_COLUMNS]].copy()
+    upload.columns = REQUIRED_UPLOAD_COLUMNS
+    
+    # A number repeated in the file keeps only its last row, so the database sees each number once
+    mobile_numbers = upload['mobile_number'].astype(str).str.strip()
+    duplicated = mobile_numbers.duplicated(keep='last') & ~mobile_numbers.str.lower().isin(['nan', 'none', ''])
+    upload = upload[~duplicated]
+    duplicate_records = int(duplicated.sum())
+    
+    # remaining is always recalculated from pledge - paid, so the column isn't read
+    records, errors = PledgeRecord.build_batch(upload)
+    
+    # Numbers written differently can still format to the same number; the last one wins
+    incoming = {}
+    for record in records:
+        incoming[record.mobile_number] = record
+    duplicate_records += len(records) - len(incoming)
+    
+    # Fetch the records that already exist in one query per batch
+    numbers = list(incoming)
+    existing = {}
+    for start in range(0, len(numbers), BULK_BATCH_SIZE):
+        existing.update(
+            (record.mobile_number, record)
+            for record in PledgeRecord.objects.filter(
+                mobile_number__in=numbers[start:start + BULK_BATCH_SIZE]
+            ).only('id', 'mobile_number', 'card_capacity')
+        )
+    
+    to_create = []
+    to_update = []
+    now = timezone.now()
+    for mobile_number, record in incoming.items():
+        current = existing.get(mobile_number)
+        if current is None:
+            to_create.append(record)
+            continue
+        current.name = record.name
+        current.pledge = record.pledge
+        current.paid = record.paid
+        current.apply_derived_fields()
+        # bulk_update doesn't touch auto_now fields
+        current.updated_at = now
+        to_update.append(current)
+    
+    created = PledgeRecord.bulk_create_with_card_codes(to_create, batch_size=BULK_BATCH_SIZE)
+    PledgeRecord.objects.bulk_update(
+        to_update,
+        ['name', 'pledge', 'paid', 'remaining', 'card_capacity', 'updated_at'],
+        batch_size=BULK_BATCH_SIZE
+    )
+    
+    new_records = len(created)
+    updated_records = len(to_update)
+    if new_records < len(to_create):
+        created_numbers = {record.mobile_number for record in created}
+        for record in to_create:
+            if record.mobile_number not in created_numbers:
+                errors.append(f"Mobile {record.mobile_number}: could not be created")
+    
+    return new_records, updated_records, duplicate_records, errors
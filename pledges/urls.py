@@ -9,9 +9,12 @@ urlpatterns = [
     path('edit/<uuid:record_id>/', views.edit_record, name='edit_record'),
     path('delete/<uuid:record_id>/', views.delete_record, name='delete_record'),
     path('logs/', views.upload_logs, name='upload_logs'),
+    path('logs/<int:log_id>/', views.upload_status, name='upload_status'),
+    path('logs/<int:log_id>/status/', views.upload_status_json, name='upload_status_json'),
     path('send-sms/<uuid:record_id>/', views.send_sms, name='send_sms'),
     path('send-bulk-sms/', views.send_bulk_sms, name='send_bulk_sms'),
     path('sms-form/', views.sms_form, name='sms_form'),
+    path('search/', views.search_records, name='search_records'),
     path('forward-sms/<uuid:record_id>/', views.forward_sms, name='forward_sms'),
     path('forward-sms-modal/<uuid:record_id>/', views.forward_sms_modal, name='forward_sms_modal'),
     path('forward-whatsapp-modal/<uuid:record_id>/', views.forward_whatsapp_modal, name='forward_whatsapp_modal'),
@@ -1,17 +1,15 @@
-from decimal import Decimal
-import threading
-import time
 import logging
 
-import pandas as pd
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.paginator import Paginator
 from django.db import transaction, IntegrityError
-from django.db import models
+from django.db.models import Count, Q, Sum
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.utils.functional import cached_property
 from django.views.decorators.http import require_POST
 from django.views.generic import ListView
 from django.http import JsonResponse
@@ -23,10 +21,61 @@ from django.http import JsonResponse
 from .forms import FileUploadForm, PledgeRecordForm, SMSForwardForm
 from .models import PledgeRecord, UploadLog, format_phone_number
 from .sms_utils import SMSService
+from .tasks import (
+    chunked, enqueue, enqueue_upload, send_invitation_whatsapp_task, send_pledge_sms_task,
+    send_pledge_whatsapp_task,
+)
+from .upload_utils import UPLOAD_EXTENSIONS, cleanup_stale_uploads, save_upload
 from .whatsapp_utils import WhatsAppService
 
 logger = logging.getLogger(__name__)
 
+# Records rendered by the SMS form, and returned per search on it
+SMS_FORM_RECORD_LIMIT = 200
+SEARCH_RESULT_LIMIT = 20
+SMS_FORM_RECORD_FIELDS = ('id', 'name', 'mobile_number', 'normal_message_sent')
+
+SMS_DEFAULT_MESSAGE = settings.SMS_DEFAULT_MESSAGE
+
+
+# Queries that are a whole phone number: 0 + 9 digits, 255 + 9 digits, or a + number
+COMPLETE_NUMBER_RE = re.compile(r'0\d{9}|255\d{9}|\+\d{9,15}')
+
+
+def build_search_filter(search_query):
+    """
+    Build a single filter for the list search box.
+    A complete phone number is an exact match on the unique index; any other digit
+    query matches part of a number, or a name that contains those digits.
+    """
+    compact = search_query.replace(' ', '')
+    digits = compact.lstrip('+')
+    if not digits.isdigit():
+        return Q(name__icontains=search_query)
+    
+    if COMPLETE_NUMBER_RE.fullmatch(compact):
+        # Numbers saved with a + prefix are kept as typed, others in local 0xxxxxxxxx form
+        candidates = {compact, format_phone_number(compact)}
+        if compact.startswith('+255') and len(digits) == 12:
+            candidates.add('0' + digits[3:])
+        return Q(mobile_number__in=sorted(candidates))
+    
+    return Q(mobile_number__contains=digits) | Q(name__icontains=search_query)
+
+
+class FastCountPaginator(Paginator):
+    """Paginator that can reuse a row count the view has already computed"""
+    
+    def __init__(self, *args, known_count=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.known_count = known_count
+    
+    @cached_property
+    def count(self):
+        if self.known_count is not None:
+            return self.known_count
+        return super().count
+
 
 class PledgeListView(LoginRequiredMixin, ListView):
     """List view for pledge records with search functionality"""
@@ -34,20 +83,26 @@ class PledgeListView(LoginRequiredMixin, ListView):
     template_name = 'pledges/list.html'
     context_object_name = 'pledges'
     paginate_by = 50
+    paginator_class = FastCountPaginator
+    
+    # Columns rendered by the list template
+    list_fields = (
+        'id', 'name', 'mobile_number', 'card_code', 'pledge', 'paid', 'remaining',
+        'card_capacity', 'attended_count', 'normal_message_sent', 'whatsapp_sent',
+    )
+
+    def has_filters(self):
+        return any(self.request.GET.get(key, '').strip() for key in ('search', 'sms_status', 'whatsapp_status'))
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = super().get_queryset().only(*self.list_fields)
         search_query = self.request.GET.get('search', '').strip()
         sms_status = self.request.GET.get('sms_status', '')
         whatsapp_status = self.request.GET.get('whatsapp_status', '')
         
         # Search filter
         if search_query:
-            queryset = queryset.filter(
-                name__icontains=search_query
-            ) | queryset.filter(
-                mobile_number__icontains=search_query
-            )
+            queryset = queryset.filter(build_search_filter(search_query))
         
         # SMS status filter
         if sms_status == 'sent':
@@ -63,27 +118,43 @@ class PledgeListView(LoginRequiredMixin, ListView):
         
         return queryset
 
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        # Unfiltered pages show every record, which the stats already counted
+        if not self.has_filters():
+            kwargs['known_count'] = self.get_stats()['total_records']
+        return super().get_paginator(queryset, per_page, orphans, allow_empty_first_page, **kwargs)
+
+    def get_stats(self):
+        """Filter statistics including attendance, computed in a single query"""
+        if not hasattr(self, '_stats'):
+            totals = PledgeRecord.objects.aggregate(
+                total_records=Count('id'),
+                sms_sent=Count('id', filter=Q(normal_message_sent=True)),
+                whatsapp_sent=Count('id', filter=Q(whatsapp_sent=True)),
+                total_attended=Sum('attended_count'),
+                total_capacity=Sum('card_capacity'),
+            )
+            total_attended = totals['total_attended'] or 0
+            total_capacity = totals['total_capacity'] or 0
+            
+            self._stats = {
+                'total_records': totals['total_records'],
+                'sms_sent': totals['sms_sent'],
+                'sms_not_sent': totals['total_records'] - totals['sms_sent'],
+                'whatsapp_sent': totals['whatsapp_sent'],
+                'whatsapp_not_sent': totals['total_records'] - totals['whatsapp_sent'],
+                'total_attended': total_attended,
+                'total_capacity': total_capacity,
+                'available_spots': total_capacity - total_attended,
+            }
+        return self._stats
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['search'] = self.request.GET.get('search', '')
         context['sms_status'] = self.request.GET.get('sms_status', '')
         context['whatsapp_status'] = self.request.GET.get('whatsapp_status', '')
-        
-        # Add filter statistics including attendance
-        all_records = PledgeRecord.objects.all()
-        total_attended = all_records.aggregate(total=models.Sum('attended_count'))['total'] or 0
-        total_capacity = all_records.aggregate(total=models.Sum('card_capacity'))['total'] or 0
-        
-        context['stats'] = {
-            'total_records': all_records.count(),
-            'sms_sent': all_records.filter(normal_message_sent=True).count(),
-            'sms_not_sent': all_records.filter(normal_message_sent=False).count(),
-            'whatsapp_sent': all_records.filter(whatsapp_sent=True).count(),
-            'whatsapp_not_sent': all_records.filter(whatsapp_sent=False).count(),
-            'total_attended': total_attended,
-            'total_capacity': total_capacity,
-            'available_spots': total_capacity - total_attended,
-        }
+        context['stats'] = self.get_stats()
         
         return context
 
@@ -137,20 +208,18 @@ def upload_file(request):
         if form.is_valid():
             uploaded_file = request.FILES['file']
             
+            if not uploaded_file.name.endswith(UPLOAD_EXTENSIONS):
+                messages.error(request, "Unsupported file format. Please upload CSV or Excel files.")
+                return redirect('upload_file')  # Redirect instead of render
+            
             try:
-                # Read the file based on extension
-                if uploaded_file.name.endswith('.csv'):
-                    df = pd.read_csv(uploaded_file)
-                elif uploaded_file.name.endswith(('.xlsx', '.xls')):
-                    df = pd.read_excel(uploaded_file)
-                else:
-                    messages.error(request, "Unsupported file format. Please upload CSV or Excel files.")
-                    return redirect('upload_file')  # Redirect instead of render
+                cleanup_stale_uploads()
                 
-                # Process the data
-                result = process_upload_data(df, uploaded_file.name)
-                messages.success(request, result['message'])
-                return redirect('pledge_list')
+                # Parsing happens on the task queue; the task deletes the saved copy when done
+                path = save_upload(uploaded_file)
+                upload_log = UploadLog.objects.create(filename=uploaded_file.name, status='queued')
+                enqueue_upload(path, upload_log)
+                return redirect('upload_status', log_id=upload_log.id)
                 
             except Exception as e:
                 messages.error(request, f"Error processing file: {str(e)}")
@@ -167,109 +236,6 @@ def upload_file(request):
     return render(request, 'pledges/upload.html', {'form': form})
 
 
-def process_upload_data(df, filename):
-    """Process uploaded data and update/create records"""
-    # Normalize column names (remove spaces, lowercase)
-    df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
-    
-    # Map possible column names
-    column_mapping = {
-        'name': ['name', 'full_name', 'person_name'],
-        'mobile_number': ['mobile_number', 'mobile', 'phone', 'phone_number', 'contact'],
-        'pledge': ['pledge', 'pledged', 'pledge_amount'],
-        'paid': ['paid', 'amount_paid', 'paid_amount'],
-        'remaining': ['remaining', 'balance', 'remaining_amount']
-    }
-    
-    # Find actual column names
-    actual_columns = {}
-    for standard_name, possible_names in column_mapping.items():
-        for possible_name in possible_names:
-            if possible_name in df.columns:
-                actual_columns[standard_name] = possible_name
-                break
-    
-    # Check required columns
-    required_columns = ['name', 'mobile_number', 'pledge', 'paid']
-    missing_columns = [col for col in required_columns if col not in actual_columns]
-    
-    if missing_columns:
-        raise ValueError(f"Missing required columns: {missing_columns}")
-    
-    total_records = len(df)
-    new_records = 0
-    updated_records = 0
-    errors = []
-    
-    with transaction.atomic():
-        for index, row in df.iterrows():
-            try:
-                mobile_number = str(row[actual_columns['mobile_number']]).strip()
-                name = str(row[actual_columns['name']]).strip()
-                pledge = Decimal(str(row[actual_columns['pledge']]).replace(',', ''))
-                paid = Decimal(str(row[actual_columns['paid']]).replace(',', ''))
-                
-                # Calculate remaining if not provided
-                if 'remaining' in actual_columns:
-                    remaining = Decimal(str(row[actual_columns['remaining']]).replace(',', ''))
-                else:
-                    remaining = pledge - paid
-                
-                # Format phone number
-                if mobile_number and mobile_number.lower() not in ['nan', 'none']:
-                    mobile_number = format_phone_number(mobile_number)
-                
-                # Skip empty rows
-                if not mobile_number or mobile_number.lower() in ['nan', 'none']:
-                    continue
-                
-                # Check if record exists
-                record, created = PledgeRecord.objects.get_or_create(
-                    mobile_number=mobile_number,
-                    defaults={
-                        'name': name,
-                        'pledge': pledge,
-                        'paid': paid,
-                        'remaining': remaining
-                    }
-                )
-                
-                if created:
-                    new_records += 1
-                else:
-                    # Update existing record
-                    record.name = name
-                    record.pledge = pledge
-                    record.paid = paid
-                    record.remaining = remaining
-                    record.save()
-                    updated_records += 1
-                    
-            except Exception as e:
-                errors.append(f"Row {index + 1}: {str(e)}")
-        
-        # Create upload log
-        UploadLog.objects.create(
-            filename=filename,
-            total_records=total_records,
-            new_records=new_records,
-            updated_records=updated_records,
-            errors='; '.join(errors) if errors else ''
-        )
-    
-    message = f"Processed {total_records} records. New: {new_records}, Updated: {updated_records}"
-    if errors:
-        message += f". Errors: {len(errors)}"
-    
-    return {
-        'total_records': total_records,
-        'new_records': new_records,
-        'updated_records': updated_records,
-        'errors': errors,
-        'message': message
-    }
-
-
 @login_required
 def edit_record(request, record_id):
     """Edit a pledge record"""
@@ -317,6 +283,29 @@ def upload_logs(request):
     return render(request, 'pledges/upload_logs.html', {'logs': logs})
 
 
+@login_required
+def upload_status(request, log_id):
+    """Processing page for a queued upload; it polls upload_status_json until the upload finishes"""
+    log = get_object_or_404(UploadLog, id=log_id)
+    return render(request, 'pledges/upload_status.html', {'log': log})
+
+
+@login_required
+def upload_status_json(request, log_id):
+    """Current status and counts of an upload"""
+    log = get_object_or_404(UploadLog, id=log_id)
+    return JsonResponse({
+        'status': log.status,
+        'status_display': log.get_status_display(),
+        'finished': log.is_finished,
+        'total_records': log.total_records,
+        'new_records': log.new_records,
+        'updated_records': log.updated_records,
+        'duplicate_records': log.duplicate_records,
+        'errors': log.errors,
+    })
+
+
 @login_required
 def view_pledge_detail(request, record_id):
     """
@@ -324,12 +313,16 @@ def view_pledge_detail(request, record_id):
     """
     record = get_object_or_404(PledgeRecord, id=record_id)
     sms_messages = record.sms_messages.all().order_by('-sent_at')
+    message_stats = record.sms_messages.aggregate(
+        sent=Count('id', filter=Q(status='sent')),
+        failed=Count('id', filter=Q(status='failed')),
+    )
     
     context = {
         'record': record,
         'sms_messages': sms_messages,
-        'total_messages_sent': sms_messages.filter(status='sent').count(),
-        'total_messages_failed': sms_messages.filter(status='failed').count(),
+        'total_messages_sent': message_stats['sent'],
+        'total_messages_failed': message_stats['failed'],
     }
     return render(request, 'pledges/pledge_detail.html', context)
 
@@ -391,15 +384,18 @@ def send_bulk_sms(request):
         sms_service = SMSService()
         results = sms_service.send_bulk_sms(eligible_records, custom_message)
         
-        successful = sum(1 for result in results if result['success'])
-        failed = len(results) - successful
+        # Split the results in one pass
+        successful_numbers = []
+        failed = 0
+        for result in results:
+            if result['success']:
+                successful_numbers.append(result['mobile_number'])
+            else:
+                failed += 1
+        successful = len(successful_numbers)
         
         # Update status for successful sends
         if successful > 0:
-            successful_numbers = [
-                result['mobile_number'] for result in results 
-                if result['success']
-            ]
             PledgeRecord.objects.filter(
                 mobile_number__in=successful_numbers
             ).update(normal_message_sent=True)
@@ -427,13 +423,38 @@ def sms_form(request):
         elif action == 'bulk':
             return send_bulk_sms(request)
     
+    # Only the first records are rendered; the rest are found through search_records
+    records = PledgeRecord.objects.only(*SMS_FORM_RECORD_FIELDS).order_by('name')[:SMS_FORM_RECORD_LIMIT]
+    totals = PledgeRecord.objects.aggregate(
+        total=Count('id'),
+        sent=Count('id', filter=Q(normal_message_sent=True)),
+    )
+    
     context = {
-        'records': PledgeRecord.objects.all(),
-        'default_message': settings.SMS_DEFAULT_MESSAGE
+        'records': records,
+        'record_limit': SMS_FORM_RECORD_LIMIT,
+        'stats': {
+            'total_records': totals['total'],
+            'sms_sent': totals['sent'],
+            'sms_pending': totals['total'] - totals['sent'],
+        },
+        'default_message': SMS_DEFAULT_MESSAGE
     }
     return render(request, 'pledges/sms_form.html', context)
 
 
+@login_required
+def search_records(request):
+    """Return records matching a name or number search as JSON for the SMS form"""
+    search_query = request.GET.get('q', '').strip()
+    if not search_query:
+        return JsonResponse({'results': []})
+    
+    records = PledgeRecord.objects.filter(build_search_filter(search_query)).order_by('name')
+    results = list(records.values(*SMS_FORM_RECORD_FIELDS)[:SEARCH_RESULT_LIMIT])
+    return JsonResponse({'results': results})
+
+
 def forward_sms(request, record_id):
     """Forward SMS to a different number without updating the original record"""
     record = get_object_or_404(PledgeRecord, id=record_id)
@@ -516,29 +537,6 @@ def forward_sms_modal(request, record_id):
     return redirect(request.META.get('HTTP_REFERER', 'pledge_list'))
 
 
-def send_background_sms_worker(unsent_records):
-    """Background worker function to send SMS to unsent records"""
-    sms_service = SMSService()
-    successful = 0
-    failed = 0
-    
-    for record in unsent_records:
-        try:
-            result = sms_service.send_pledge_sms(record)
-            if result['success']:
-                record.normal_message_sent = True
-                record.save()
-                successful += 1
-                # Small delay to avoid rate limiting
-                time.sleep(1)
-            else:
-                failed += 1
-        except Exception as e:
-            print(f"Error sending SMS to {record.name} ({record.mobile_number}): {str(e)}")
-            failed += 1
-    
-    print(f"Background SMS batch completed: {successful} successful, {failed} failed")
-
 @login_required
 @require_POST
 def send_background_sms_all(request):
@@ -552,18 +550,15 @@ def send_background_sms_all(request):
             messages.info(request, "No unsent messages found. All records have already received SMS.")
             return redirect('pledge_list')
         
-        # Start background thread to send SMS
-        thread = threading.Thread(
-            target=send_background_sms_worker, 
-            args=(list(unsent_records),)
-        )
-        thread.daemon = True
-        thread.start()
+        # Queue one background task per chunk of record IDs
+        record_ids = list(unsent_records.values_list('id', flat=True))
+        for chunk in chunked(record_ids):
+            enqueue(send_pledge_sms_task, chunk)
         
         messages.success(
             request, 
             f"Started sending SMS to {total_count} records in the background. "
-            f"This will take approximately {total_count} minutes to complete."
+            f"This may take a few minutes to complete."
         )
         
     except Exception as e:
@@ -608,6 +603,7 @@ def forward_whatsapp_modal(request, record_id):
                     self.pledge = original_record.pledge
                     self.paid = original_record.paid
                     self.invitation_image_url = original_record.invitation_image_url
+                    self.updated_at = original_record.updated_at
                 
                 def save(self):
                     # Do nothing - this is a temporary record for forwarding only
@@ -643,17 +639,12 @@ def send_whatsapp(request, record_id):
         messages.error(request, f"Cannot send WhatsApp to {record.name}: Paid amount ({record.paid:,.0f}) must be more than 50,000")
         return redirect('pledge_list')
     
-    try:
-        whatsapp_service = WhatsAppService()
-        result = whatsapp_service.send_invitation_whatsapp(record)
-        
-        if result['success']:
-            messages.success(request, f"WhatsApp invitation sent successfully to {record.name}")
-        else:
-            messages.error(request, f"Failed to send WhatsApp to {record.name}: {result['error']}")
-            
-    except Exception as e:
-        messages.error(request, f"Error sending WhatsApp: {str(e)}")
+    # Rendering the card and calling the API happen on the background pool
+    enqueue(send_invitation_whatsapp_task, record.id)
+    messages.success(
+        request,
+        f"WhatsApp invitation for {record.name} queued. The WhatsApp status updates once it is sent."
+    )
     
     return redirect('pledge_list')
 
@@ -687,16 +678,19 @@ def send_bulk_whatsapp(request):
             messages.warning(request, f"Limited to first 100 eligible records (out of {all_records.filter(paid__gt=50000).count()})")
         
         whatsapp_service = WhatsAppService()
-        successful = 0
+        unsent_records = [record for record in eligible_records if not record.whatsapp_sent]
+        sent_ids = []
         failed = 0
         
-        for record in eligible_records:
-            if not record.whatsapp_sent:
-                result = whatsapp_service.send_invitation_whatsapp(record)
-                if result['success']:
-                    successful += 1
-                else:
-                    failed += 1
+        for record, result in whatsapp_service.send_invitations_bulk(unsent_records, mark_sent=False):
+            if result['success']:
+                sent_ids.append(record.id)
+            else:
+                failed += 1
+        
+        if sent_ids:
+            PledgeRecord.objects.filter(id__in=sent_ids).update(whatsapp_sent=True)
+        successful = len(sent_ids)
                     
         messages.success(request, f"WhatsApp invitations: {successful} sent, {failed} failed")
         
@@ -732,17 +726,12 @@ def send_background_whatsapp_all(request):
             logger.info(f"Limited to first 100 records out of {total_count}")
             total_count = 100
         
-        # Convert to list and log record details
-        record_list = list(unsent_records)
-        logger.info(f"Records to process: {[f'{r.name} ({r.id})' for r in record_list]}")
+        # Hand record IDs to the task queue; each task re-fetches its own chunk
+        record_ids = list(unsent_records.values_list('id', flat=True))
+        logger.info(f"Records to process: {record_ids}")
         
-        # Start background thread to send WhatsApp
-        thread = threading.Thread(
-            target=send_background_whatsapp_worker, 
-            args=(record_list,)
-        )
-        thread.daemon = True
-        thread.start()
+        for chunk in chunked(record_ids):
+            enqueue(send_pledge_whatsapp_task, chunk)
         
         messages.success(
             request, 
@@ -757,34 +746,6 @@ def send_background_whatsapp_all(request):
     return redirect('pledge_list')
 
 
-def send_background_whatsapp_worker(records):
-    """Background worker function to send WhatsApp invitations"""
-    logger.info(f"Starting WhatsApp background worker for {len(records)} records")
-    whatsapp_service = WhatsAppService()
-    successful_count = 0
-    failed_count = 0
-    
-    for record in records:
-        try:
-            logger.info(f"Processing WhatsApp for {record.name} (ID: {record.id})")
-            result = whatsapp_service.send_invitation_whatsapp(record)
-            if result['success']:
-                successful_count += 1
-                logger.info(f"✓ WhatsApp invitation sent to {record.name}")
-            else:
-                failed_count += 1
-                logger.error(f"✗ Failed to send WhatsApp to {record.name}: {result['error']}")
-                
-            # Add small delay to avoid rate limiting
-            time.sleep(2)
-            
-        except Exception as e:
-            failed_count += 1
-            logger.error(f"✗ Error sending WhatsApp to {record.name}: {str(e)}", exc_info=True)
-    
-    logger.info(f"Background WhatsApp batch completed: {successful_count} successful, {failed_count} failed")
-
-
 def verify_record(request, record_id):
     """API endpoint for app verification/scanning - returns all records with essential data"""
     try:
@@ -3,35 +3,134 @@ import json
 import logging
 import requests
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from urllib3.util.retry import Retry
+from functools import lru_cache
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 import qrcode
 from qrcode.constants import ERROR_CORRECT_H
 from django.conf import settings
+from django.db import connection
 from django.urls import reverse
 from .models import PledgeRecord
 
 logger = logging.getLogger(__name__)
 
+_SESSION = None
+
+# Concurrent sends in send_invitations_bulk; kept below the session's pool size
+WHATSAPP_SEND_WORKERS = getattr(settings, 'WHATSAPP_SEND_WORKERS', 8)
+
+# Concurrent invitation renders; Pillow releases the GIL while encoding
+IMAGE_WORKERS = getattr(settings, 'WHATSAPP_IMAGE_WORKERS', min(4, os.cpu_count() or 1))
+
+QR_MASK_PATTERN = 0
+QR_BORDER = 2
+
+# Decoded invitation template, keyed by (path, mtime); only the latest one is kept
+_TEMPLATE_CACHE = {}
+_TEMPLATE_LOCK = threading.Lock()
+
+# Templates with a name already drawn, kept for re-sends and retries; each entry is a
+# full-size RGB card (about 5 MB for the default template), so keep this small
+NAMED_TEMPLATE_CACHE_SIZE = getattr(settings, 'WHATSAPP_NAMED_TEMPLATE_CACHE_SIZE', 16)
+
+
+def _get_session():
+    """
+    Return the shared HTTP session for the WhatsApp API so pooled keep-alive
+    connections are reused across messages and requests
+    """
+    global _SESSION
+    if _SESSION is None:
+        # Sends are not idempotent, so only retry when Meta can't have accepted the
+        # message: failed connections and 429 throttling. Read timeouts and 5xx
+        # gateway errors may come after the message was delivered, so they aren't retried
+        retry = Retry(
+            total=3,
+            connect=3,
+            read=0,
+            other=0,
+            backoff_factor=0.3,
+            status_forcelist=[429],
+            allowed_methods=frozenset(['POST']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        _SESSION = session
+    return _SESSION
+
+
+_SAFE_FILENAME_RE = re.compile(r"[^a-z0-9]+")
+
+# One pattern per accepted form: +<digits>, 0 + 9 digits, 255 + 9 digits
+_WHATSAPP_PHONE_RE = re.compile(r"^(?:\+(\d+)|0(\d{9})|(255\d{9}))$")
+
+
+def request_never_sent(error):
+    """
+    True if a requests error was raised before the request was written, so the API
+    can't have received it. Dropped connections and read errors after the request
+    went out also surface as ConnectionError, so only connect failures count.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        reason = error.args[0] if error.args else None
+        if isinstance(reason, MaxRetryError):
+            reason = reason.reason
+        return isinstance(reason, NewConnectionError)
+    return False
+
 
 def safe_filename(s: str) -> str:
-    s = s.strip().lower()
-    s = re.sub(r"[^a-z0-9]+", "_", s)
+    s = _SAFE_FILENAME_RE.sub("_", s.strip().lower())
     return s.strip("_") or "invitee"
 
 
 def load_font(paths, size):
+    """Return the first available font from paths; fonts are parsed once per process"""
+    return _load_font(tuple(paths), size)
+
+
+@lru_cache(maxsize=32)
+def _load_font(paths, size):
     for p in paths:
-        print("Checking font path:", p)
         if p and os.path.exists(p):
-            print("Using font:", repr(p))
+            logger.debug(f"Using font: {p!r}")
             return ImageFont.truetype(p, size=size)
+    logger.warning(f"No font found in {list(paths)}, using the default font")
     return ImageFont.load_default()
 
 
-def add_dear_name(img, invitee_name):
-    """Draw 'Dear Name' on the image"""
-    draw = ImageDraw.Draw(img)
+def load_template(template_path):
+    """
+    Return a copy of the decoded invitation template.
+    The decoded image is cached per (path, mtime), so replacing the file takes effect.
+    """
+    key = (str(template_path), os.path.getmtime(template_path))
+    with _TEMPLATE_LOCK:
+        template = _TEMPLATE_CACHE.get(key)
+        if template is None:
+            source = Image.open(template_path)
+            # JPEG templates decode straight to RGB; draft() does nothing for PNG
+            source.draft("RGB", source.size)
+            # Converting an image that is already RGB would only copy the buffer
+            template = source if source.mode == "RGB" else source.convert("RGB")
+            template.load()
+            _TEMPLATE_CACHE.clear()
+            _TEMPLATE_CACHE[key] = template
+    return template.copy()
+
+
+def add_dear_name(img, draw, invitee_name):
+    """Draw 'Dear Name' on the image using draw, an ImageDraw for img"""
 
     # Try to load elegant font from project fonts directory
     font_paths = [
@@ -64,26 +163,59 @@ def add_dear_name(img, invitee_name):
     return img
 
 
-def add_qr(img, qr_data, cardType):
-    """Add QR code to bottom center of image"""
-    w, h = img.size
+def load_named_template(template_path, invitee_name):
+    """Return a copy of the invitation template with 'Habari <name>' already drawn"""
+    key = (str(template_path), os.path.getmtime(template_path))
+    return _named_template(key, invitee_name).copy()
+
+
+@lru_cache(maxsize=NAMED_TEMPLATE_CACHE_SIZE)
+def _named_template(template_key, invitee_name):
+    # template_key carries the mtime so a replaced template isn't served from cache
+    img = load_template(template_key[0])
+    return add_dear_name(img, ImageDraw.Draw(img), invitee_name)
+
 
+@lru_cache(maxsize=256)
+def render_qr(qr_data, qr_size):
+    """
+    Render qr_data as a qr_size x qr_size RGB image.
+    Cached so re-sends and retries don't re-encode; callers only paste it, never modify it.
+    """
+    # A fixed mask skips the library's scoring of all 8 masks; any mask scans fine
     qr = qrcode.QRCode(
         error_correction=ERROR_CORRECT_H,
-        box_size=10,
-        border=2
+        border=QR_BORDER,
+        mask_pattern=QR_MASK_PATTERN
     )
 
     qr.add_data(qr_data)
     qr.make(fit=True)
 
-    qr_img = qr.make_image(
-        fill_color="black",
-        back_color="white"
-    ).convert("RGB")
+    # Build the image from the module matrix (border included) in one call instead of
+    # letting qrcode draw every module as a rectangle. The largest whole-pixel module
+    # size that fits is used and the rest is padded with white quiet zone, so the
+    # image is exactly qr_size without a resampling pass
+    matrix = qr.get_matrix()
+    modules = len(matrix)
+    box_size = max(1, qr_size // modules)
+    pixels = bytes(0 if dark else 255 for row in matrix for dark in row)
+    code_img = Image.frombytes("L", (modules, modules), pixels).resize(
+        (modules * box_size, modules * box_size), Image.Resampling.NEAREST
+    )
+
+    qr_img = Image.new("L", (qr_size, qr_size), 255)
+    offset = max(0, (qr_size - code_img.width) // 2)
+    qr_img.paste(code_img, (offset, offset))
+    return qr_img.convert("RGB")
+
+
+def add_qr(img, draw, qr_data, cardType):
+    """Add QR code to bottom center of image using draw, an ImageDraw for img"""
+    w, h = img.size
 
     qr_size = int(min(w, h) * 0.18)
-    qr_img = qr_img.resize((qr_size, qr_size), Image.Resampling.LANCZOS)
+    qr_img = render_qr(qr_data, qr_size)
 
     # Bottom center
     x = (w - qr_size) // 2
@@ -99,8 +231,6 @@ def add_qr(img, qr_data, cardType):
 
     text = f"{cardType}"
 
-    draw = ImageDraw.Draw(img)
-
     y = y+190
     x = x+70
 
@@ -120,30 +250,49 @@ class WhatsAppService:
         self.phone_number_id = getattr(settings, 'WHATSAPP_PHONE_NUMBER_ID', '')
         self.template_name = getattr(settings, 'WHATSAPP_TEMPLATE_NAME', 'kadi_mualiko')
         self.base_url = f"https://graph.facebook.com/v18.0/{self.phone_number_id}/messages"
+        self.media_url = f"https://graph.facebook.com/v18.0/{self.phone_number_id}/media"
+        # Upload the image to Meta and send it by id rather than asking Meta to fetch BASE_URL
+        self.use_media_upload = getattr(settings, 'WHATSAPP_UPLOAD_MEDIA', True)
+        self.session = _get_session()
         
     def format_phone_for_whatsapp(self, phone_number):
         """Format phone number for WhatsApp API (255xxxxxxxxx format)"""
         if not phone_number:
             return None
             
-        phone_str = str(phone_number).strip()
+        match = _WHATSAPP_PHONE_RE.match(str(phone_number).strip())
+        if not match:
+            return None
         
-        # If already starts with +, remove + and return
-        if phone_str.startswith('+'):
-            return phone_str[1:]
-            
-        # If starts with 0, replace with 255
-        if phone_str.startswith('0') and len(phone_str) == 10:
-            return '255' + phone_str[1:]
-            
-        # If already starts with 255, return as is
-        if phone_str.startswith('255') and len(phone_str) == 12:
-            return phone_str
-            
-        return None
+        international, local, full = match.groups()
+        # +<digits> loses the +, 0xxxxxxxxx becomes 255xxxxxxxxx, 255xxxxxxxxx is kept
+        if local:
+            return '255' + local
+        return international or full
+        
+    def _update_record(self, pledge_record, **fields):
+        """
+        Set fields on the record and write only those columns with a single UPDATE.
+        Stand-in objects that aren't PledgeRecords (e.g. forwarding copies) keep their own save().
+        """
+        for field, value in fields.items():
+            setattr(pledge_record, field, value)
+        if isinstance(pledge_record, PledgeRecord):
+            PledgeRecord.objects.filter(pk=pledge_record.pk).update(**fields)
+        else:
+            pledge_record.save()
+        
+    def invitation_image_path(self, pledge_record):
+        """Path of the generated invitation image for a pledge record"""
+        safe_name = safe_filename(pledge_record.name)
+        image_filename = f"invite_{safe_name}_{pledge_record.card_code}.png"
+        return Path(settings.BASE_DIR) / 'static' / 'invitations' / image_filename
         
-    def generate_invitation_image(self, pledge_record):
-        """Generate invitation image using the create_image script - always regenerate to replace existing"""
+    def generate_invitation_image(self, pledge_record, force=False):
+        """
+        Generate the invitation image and return its URL.
+        A saved image that is still current is reused unless force is set.
+        """
         try:
             # Path to template image
             template_path = Path(settings.BASE_DIR) / 'static' / 'invitations' / 'template.png'
@@ -153,39 +302,39 @@ class WhatsAppService:
                 return None
                 
             # Create invitations directory if it doesn't exist
-            invitations_dir = Path(settings.BASE_DIR) / 'static' / 'invitations'
-            invitations_dir.mkdir(parents=True, exist_ok=True)
+            image_path = self.invitation_image_path(pledge_record)
+            image_path.parent.mkdir(parents=True, exist_ok=True)
+            image_filename = image_path.name
             
-            # Generate safe filename
-            safe_name = safe_filename(pledge_record.name)
-            image_filename = f"invite_{safe_name}_{pledge_record.card_code}.png"
-            image_path = invitations_dir / image_filename
+            # Generate full URL using configurable BASE_URL
+            base_url = getattr(settings, 'BASE_URL', 'http://127.0.0.1:8000')
+            image_url = f"{base_url}{settings.STATIC_URL}invitations/{image_filename}"
+            
+            if not force and pledge_record.invitation_image_url == image_url and self._image_is_current(
+                image_path, template_path, pledge_record
+            ):
+                logger.info(f"Reusing invitation image for {pledge_record.name}: {image_url}")
+                return image_url
             
             # If image already exists, log that we're replacing it
             if image_path.exists():
                 logger.info(f"Replacing existing invitation image for {pledge_record.name}: {image_path}")
             
-            # Generate image using the create_image functions
-            base_image = Image.open(template_path).convert("RGB")
-            
-            # Add name to image
-            image_with_name = add_dear_name(base_image, pledge_record.name)
+            # Template with the name drawn; repeated names reuse a cached render
+            base_image = load_named_template(template_path, pledge_record.name)
+            draw = ImageDraw.Draw(base_image)
             
             # Add QR code with card information
             capacity_text = "double" if pledge_record.card_capacity == 2 else "single"
             qr_data = f"Card: {pledge_record.card_code} | Capacity: {pledge_record.card_capacity} {capacity_text}"
-            final_image = add_qr(image_with_name, qr_data, capacity_text)
+            final_image = add_qr(base_image, draw, qr_data, capacity_text)
             
-            # Save the image (overwriting if it exists)
-            final_image.save(str(image_path), quality=95)
-            
-            # Generate full URL using configurable BASE_URL
-            base_url = getattr(settings, 'BASE_URL', 'http://127.0.0.1:8000')
-            image_url = f"{base_url}{settings.STATIC_URL}invitations/{image_filename}"
+            # Save the image (overwriting if it exists); light compression is much
+            # cheaper to encode and Meta re-encodes the image anyway
+            final_image.save(str(image_path), format="PNG", compress_level=1, optimize=False)
             
             # Update the pledge record with the URL
-            pledge_record.invitation_image_url = image_url
-            pledge_record.save()
+            self._update_record(pledge_record, invitation_image_url=image_url)
             
             logger.info(f"Generated invitation image for {pledge_record.name}: {image_url}")
             return image_url
@@ -194,8 +343,52 @@ class WhatsAppService:
             logger.error(f"Error generating invitation image for {pledge_record.name}: {str(e)}")
             return None
             
-    def send_whatsapp_template(self, phone_number, image_url, message_text="Your wedding invitation"):
-        """Send WhatsApp template message"""
+    def _image_is_current(self, image_path, template_path, pledge_record):
+        """
+        True if the saved image is newer than the template and the record's last change,
+        so the name, card code and capacity drawn on it are still up to date
+        """
+        try:
+            image_mtime = image_path.stat().st_mtime
+        except OSError:
+            return False
+        if image_mtime < template_path.stat().st_mtime:
+            return False
+        # Without updated_at there's no way to tell whether the record changed, so re-render
+        updated_at = getattr(pledge_record, 'updated_at', None)
+        return updated_at is not None and image_mtime >= updated_at.timestamp()
+            
+    def upload_media(self, image_path):
+        """Upload an invitation image to the WhatsApp media API and return its media id, or None"""
+        return self._upload_media(image_path)[0]
+        
+    def _upload_media(self, image_path):
+        """Upload an invitation image; returns (media id or None, HTTP status code)"""
+        if not self.api_token or not self.phone_number_id:
+            raise Exception("WhatsApp API credentials not configured")
+        
+        headers = {
+            'Authorization': f'Bearer {self.api_token}'
+        }
+        
+        with open(image_path, 'rb') as image_file:
+            response = self.session.post(
+                self.media_url,
+                headers=headers,
+                data={'messaging_product': 'whatsapp', 'type': 'image/png'},
+                files={'file': (Path(image_path).name, image_file, 'image/png')}
+            )
+        
+        if response.status_code == 200:
+            media_id = response.json().get('id')
+            logger.info(f"Uploaded invitation image {image_path}. Media ID: {media_id}")
+            return media_id, response.status_code
+        
+        logger.error(f"WhatsApp media upload error for {image_path}: HTTP {response.status_code}: {response.text}")
+        return None, response.status_code
+        
+    def send_whatsapp_template(self, phone_number, image_url=None, message_text="Your wedding invitation", media_id=None):
+        """Send WhatsApp template message; the header image is media_id if given, otherwise image_url"""
         if not self.api_token or not self.phone_number_id:
             raise Exception("WhatsApp API credentials not configured")
             
@@ -219,9 +412,7 @@ class WhatsAppService:
                         "parameters": [
                             {
                                 "type": "image",
-                                "image": {
-                                    "link": image_url
-                                }
+                                "image": {"id": media_id} if media_id else {"link": image_url}
                             }
                         ]
                     },
@@ -240,13 +431,17 @@ class WhatsAppService:
         }
         
         logger.info(f"Sending WhatsApp message to {phone_number}")
-        logger.debug(f"WhatsApp API payload: {json.dumps(payload, indent=2)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"WhatsApp API payload: {json.dumps(payload, indent=2)}")
         
-        response = requests.post(self.base_url, headers=headers, json=payload)
+        # Serialise once, compactly; the Content-Type header is already set above
+        body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        response = self.session.post(self.base_url, headers=headers, data=body)
         
         # Log the raw response
         logger.info(f"WhatsApp API response status: {response.status_code}")
-        logger.debug(f"WhatsApp API raw response: {response.text}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"WhatsApp API raw response: {response.text}")
         
         if response.status_code == 200:
             result = response.json()
@@ -254,7 +449,8 @@ class WhatsAppService:
             
             # Log successful response details
             logger.info(f"WhatsApp message sent successfully to {phone_number}. Message ID: {message_id}")
-            logger.debug(f"WhatsApp success response: {json.dumps(result, indent=2)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"WhatsApp success response: {json.dumps(result, indent=2)}")
             
             return {
                 'success': True,
@@ -272,14 +468,21 @@ class WhatsAppService:
             except:
                 logger.error(f"Could not parse error response as JSON: {response.text}")
                 
+            # Only throttling is worth retrying: a 5xx may come after Meta accepted the message,
+            # and other 4xx rejections (bad number, template, credentials) won't change
             return {
                 'success': False,
                 'error': error_msg,
-                'response': response.text
+                'response': response.text,
+                'retryable': response.status_code == 429
             }
             
-    def send_invitation_whatsapp(self, pledge_record):
-        """Send WhatsApp invitation to a pledge record"""
+    def send_invitation_whatsapp(self, pledge_record, mark_sent=True, image_url=None):
+        """
+        Send WhatsApp invitation to a pledge record.
+        Pass mark_sent=False when the caller updates whatsapp_sent itself in bulk,
+        and image_url when the invitation image has already been generated.
+        """
         logger.info(f"Starting WhatsApp invitation process for {pledge_record.name} (ID: {pledge_record.id})")
         
         try:
@@ -290,18 +493,21 @@ class WhatsAppService:
                 logger.error(f"Phone format error for {pledge_record.name}: {error_msg}")
                 return {
                     'success': False,
-                    'error': error_msg
+                    'error': error_msg,
+                    'retryable': False
                 }
                 
             # Generate or get existing image URL
-            logger.info(f"Generating invitation image for {pledge_record.name}")
-            image_url = self.generate_invitation_image(pledge_record)
+            if image_url is None:
+                logger.info(f"Generating invitation image for {pledge_record.name}")
+                image_url = self.generate_invitation_image(pledge_record)
             if not image_url:
                 error_msg = "Failed to generate invitation image"
                 logger.error(f"Image generation failed for {pledge_record.name}: {error_msg}")
                 return {
                     'success': False,
-                    'error': error_msg
+                    'error': error_msg,
+                    'retryable': False
                 }
                 
             # Image URL is now already a full URL from generate_invitation_image
@@ -312,14 +518,26 @@ class WhatsAppService:
             message_text = f"Habari {pledge_record.name}, unakaribishwa rasmi kwenye sherehe ya harusi.!"
             logger.info(f"Sending WhatsApp to {whatsapp_phone} with message: {message_text}")
             
+            media_id = None
+            if self.use_media_upload:
+                media_id, status_code = self._upload_media(self.invitation_image_path(pledge_record))
+                if not media_id:
+                    # Nothing was sent yet, so throttling and server errors can be retried
+                    return {
+                        'success': False,
+                        'error': "Failed to upload invitation image",
+                        'retryable': status_code == 429 or status_code >= 500
+                    }
+            
             # Send WhatsApp message
-            result = self.send_whatsapp_template(whatsapp_phone, full_image_url, message_text)
+            result = self.send_whatsapp_template(whatsapp_phone, full_image_url, message_text, media_id=media_id)
             
             # Log the final result
             if result['success']:
                 # Update the record to mark WhatsApp as sent
                 pledge_record.whatsapp_sent = True
-                pledge_record.save()
+                if mark_sent:
+                    self._update_record(pledge_record, whatsapp_sent=True)
                 
                 logger.info(f"✓ WhatsApp invitation completed successfully for {pledge_record.name} ({whatsapp_phone}). Message ID: {result.get('message_id', 'N/A')}")
             else:
@@ -330,7 +548,56 @@ class WhatsAppService:
         except Exception as e:
             error_msg = f"Unexpected error sending WhatsApp to {pledge_record.name}: {str(e)}"
             logger.error(error_msg, exc_info=True)
+            # A connection that was never made can't have delivered anything
             return {
                 'success': False,
-                'error': str(e)
-            }
\ No newline at end of file
+                'error': str(e),
+                'retryable': request_never_sent(e)
+            }
+
+    def send_invitations_bulk(self, pledge_records, mark_sent=True, max_workers=WHATSAPP_SEND_WORKERS):
+        """
+        Send invitations to several records concurrently over the shared session.
+        Images are generated on a separate pool and each send starts as soon as
+        its image is ready, so rendering overlaps with requests already in flight.
+        Yields (record, result) pairs as each send completes.
+        """
+        with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as image_pool, \
+                ThreadPoolExecutor(max_workers=max_workers) as send_pool:
+            image_futures = {}
+            for record in pledge_records:
+                # Don't render images for numbers that can't be sent to
+                if not self.format_phone_for_whatsapp(record.mobile_number):
+                    yield record, {
+                        'success': False,
+                        'error': f"Invalid phone number format: {record.mobile_number}",
+                        'retryable': False
+                    }
+                    continue
+                image_futures[image_pool.submit(self._generate_image_in_thread, record)] = record
+            
+            send_futures = {}
+            for future in as_completed(image_futures):
+                record = image_futures[future]
+                image_url = future.result()
+                if not image_url:
+                    yield record, {'success': False, 'error': "Failed to generate invitation image", 'retryable': False}
+                    continue
+                send_futures[send_pool.submit(self._send_invitation_in_thread, record, mark_sent, image_url)] = record
+            
+            for future in as_completed(send_futures):
+                yield send_futures[future], future.result()
+
+    def _generate_image_in_thread(self, pledge_record):
+        """Generate one invitation image from a pool thread and close that thread's DB connection"""
+        try:
+            return self.generate_invitation_image(pledge_record)
+        finally:
+            connection.close()
+
+    def _send_invitation_in_thread(self, pledge_record, mark_sent, image_url):
+        """Send one invitation from a pool thread and close that thread's DB connection"""
+        try:
+            return self.send_invitation_whatsapp(pledge_record, mark_sent=mark_sent, image_url=image_url)
+        finally:
+            connection.close()